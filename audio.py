@@ -1,14 +1,67 @@
 import datetime
+import functools
+import mmap
 import os
+import struct
 import subprocess
 
+import numpy as np
 import srt
 
 import util
 
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
 
-def duration_of(fname):
-    "Returns the duration of the given audio file in seconds"
+
+def wav_info(fname):
+    """Reads the RIFF/WAVE headers of `fname`. Returns a dict describing the
+    sample format and where the PCM data lives, or None if the file isn't a
+    WAV we can make sense of."""
+    with open(fname, "rb") as f:
+        riff = f.read(12)
+        if len(riff) < 12 or riff[0:4] != b"RIFF" or riff[8:12] != b"WAVE":
+            return None
+        info = {}
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return None
+            chunk_id, size = struct.unpack("<4sI", header)
+            if chunk_id == b"fmt ":
+                fmt = f.read(size)
+                tag, channels, rate, byte_rate, block_align, bits = struct.unpack(
+                    "<HHIIHH", fmt[:16]
+                )
+                if tag == WAVE_FORMAT_EXTENSIBLE and len(fmt) >= 26:
+                    tag = struct.unpack("<H", fmt[24:26])[0]
+                info.update(
+                    format=tag,
+                    channels=channels,
+                    rate=rate,
+                    byte_rate=byte_rate,
+                    block_align=block_align,
+                    width=bits // 8,
+                )
+                if size % 2:
+                    f.seek(1, os.SEEK_CUR)
+            elif chunk_id == b"data":
+                if "byte_rate" not in info or not info["byte_rate"]:
+                    return None
+                offset = f.tell()
+                available = os.fstat(f.fileno()).st_size - offset
+                # Streamed WAVs sometimes leave the size as 0 or 0xFFFFFFFF
+                if size == 0 or size == 0xFFFFFFFF or size > available:
+                    size = available
+                size -= size % info["block_align"]
+                info.update(data_offset=offset, data_size=size)
+                return info
+            else:
+                f.seek(size + size % 2, os.SEEK_CUR)
+
+
+def _ffprobe_duration(fname):
     cmd = [
         "ffprobe",
         "-show_entries",
@@ -20,6 +73,19 @@ def duration_of(fname):
     return float(util.silent_cmd(cmd))
 
 
+@functools.lru_cache(maxsize=4096)
+def _duration_of(fname, mtime, size):
+    if (info := wav_info(fname)) is not None:
+        return info["data_size"] / info["byte_rate"]
+    return _ffprobe_duration(fname)
+
+
+def duration_of(fname):
+    "Returns the duration of the given audio file in seconds"
+    stat = os.stat(fname)
+    return _duration_of(os.path.abspath(fname), stat.st_mtime_ns, stat.st_size)
+
+
 def silence(duration, rate=24000, channels=1):
     fname = f"silence-{duration}.wav"
     if not os.path.exists(fname):
@@ -40,7 +106,259 @@ def silence(duration, rate=24000, channels=1):
     return fname
 
 
-def stitch(files_and_silences_list):
+# What we stitch to when there's no input file to take the format from.
+DEFAULT_PARAMS = {"format": WAVE_FORMAT_PCM, "channels": 1, "rate": 24000, "width": 2}
+CHUNK_BYTES = 1 << 20
+
+_DTYPES = {
+    (WAVE_FORMAT_PCM, 1): np.uint8,
+    (WAVE_FORMAT_PCM, 2): np.int16,
+    (WAVE_FORMAT_PCM, 4): np.int32,
+    (WAVE_FORMAT_IEEE_FLOAT, 4): np.float32,
+    (WAVE_FORMAT_IEEE_FLOAT, 8): np.float64,
+}
+
+
+def _params(info):
+    return {k: info[k] for k in DEFAULT_PARAMS}
+
+
+def params_of(fname):
+    "The sample format of the given WAV, in the shape `WavWriter` takes"
+    return _params(wav_info(fname))
+
+
+def _decode(raw, params):
+    "Raw PCM bytes -> float32 array of shape (frames, channels) in [-1, 1]"
+    fmt, width = params["format"], params["width"]
+    if fmt == WAVE_FORMAT_PCM and width == 3:
+        b = np.frombuffer(raw, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+        arr = (b[:, 0] | (b[:, 1] << 8) | (b[:, 2] << 16)) << 8
+        arr = arr.astype(np.float32) / 2**31
+    else:
+        arr = np.frombuffer(raw, dtype=_DTYPES[(fmt, width)]).astype(np.float32)
+        if fmt == WAVE_FORMAT_PCM:
+            if width == 1:
+                arr = arr - 128
+            arr /= 2 ** (8 * width - 1)
+    return arr.reshape(-1, params["channels"])
+
+
+def _encode(arr, params):
+    fmt, width = params["format"], params["width"]
+    if fmt == WAVE_FORMAT_IEEE_FLOAT:
+        return arr.astype(_DTYPES[(fmt, width)]).tobytes()
+    scaled = np.clip(arr, -1.0, 1.0 - 2 ** -(8 * width - 1)) * 2 ** (8 * width - 1)
+    if width == 3:
+        ints = scaled.astype(np.int32).reshape(-1, 1)
+        return (ints.view(np.uint8).reshape(-1, 4)[:, :3]).tobytes()
+    if width == 1:
+        scaled = scaled + 128
+    return scaled.astype(_DTYPES[(fmt, width)]).tobytes()
+
+
+def _convert(raw, src, dst):
+    "Re-encodes raw PCM from the `src` format to the `dst` format"
+    arr = _decode(raw, src)
+    if src["channels"] != dst["channels"]:
+        if dst["channels"] == 1:
+            arr = arr.mean(axis=1, keepdims=True)
+        else:
+            arr = np.repeat(arr[:, :1], dst["channels"], axis=1)
+    if src["rate"] != dst["rate"] and len(arr):
+        n = int(round(len(arr) * dst["rate"] / src["rate"]))
+        old_t = np.arange(len(arr)) / src["rate"]
+        new_t = np.arange(n) / dst["rate"]
+        arr = np.stack(
+            [np.interp(new_t, old_t, arr[:, c]) for c in range(arr.shape[1])], axis=1
+        )
+    return _encode(arr, dst)
+
+
+class WavWriter:
+    """Streams PCM into a WAV file, fixing up the RIFF sizes on `close`.
+
+    If `fname` already holds a WAV, new audio is appended to it and its
+    format wins over `params`. Pass `keep_seconds` to append after that much
+    of it, dropping whatever came later. Files in any other format are
+    converted to match as they're written."""
+
+    def __init__(self, fname, params=None, keep_seconds=None):
+        self.fname = fname
+        info = wav_info(fname) if os.path.exists(fname) else None
+        if info is not None:
+            self.params = _params(info)
+            self._file = open(fname, "r+b")
+            self._data_offset = info["data_offset"]
+            self._data_size = info["data_size"]
+            if keep_seconds is not None:
+                frames = int(round(keep_seconds * info["rate"]))
+                self._data_size = min(self._data_size, frames * info["block_align"])
+            self._file.seek(self._data_offset + self._data_size)
+            self._file.truncate()
+        else:
+            self.params = {**DEFAULT_PARAMS, **(params or {})}
+            self._file = open(fname, "wb")
+            self._write_header()
+        self._block_align = self.params["channels"] * self.params["width"]
+
+    def _write_header(self):
+        p = self.params
+        fmt = struct.pack(
+            "<HHIIHH",
+            p["format"],
+            p["channels"],
+            p["rate"],
+            p["rate"] * p["channels"] * p["width"],
+            p["channels"] * p["width"],
+            p["width"] * 8,
+        )
+        if p["format"] != WAVE_FORMAT_PCM:
+            fmt += struct.pack("<H", 0)
+        self._file.write(b"RIFF\x00\x00\x00\x00WAVE")
+        self._file.write(b"fmt " + struct.pack("<I", len(fmt)) + fmt)
+        self._file.write(b"data\x00\x00\x00\x00")
+        self._data_offset = self._file.tell()
+        self._data_size = 0
+
+    @property
+    def seconds(self):
+        return self._data_size / (self._block_align * self.params["rate"])
+
+    def write(self, raw):
+        self._file.write(raw)
+        self._data_size += len(raw)
+
+    def write_silence(self, seconds):
+        frames = int(round(seconds * self.params["rate"]))
+        zero = b"\x80" if self.params["width"] == 1 else b"\x00"
+        remaining = frames * self._block_align
+        while remaining > 0:
+            n = min(remaining, CHUNK_BYTES)
+            self.write(zero * n)
+            remaining -= n
+
+    def write_file(self, fname):
+        info = wav_info(fname)
+        assert info is not None, f"Not a WAV file: {fname}"
+        if info["data_size"] == 0:
+            return
+        start, end = info["data_offset"], info["data_offset"] + info["data_size"]
+        with open(fname, "rb") as f, mmap.mmap(
+            f.fileno(), 0, access=mmap.ACCESS_READ
+        ) as m:
+            if _params(info) == self.params:
+                for offset in range(start, end, CHUNK_BYTES):
+                    self.write(m[offset : min(offset + CHUNK_BYTES, end)])
+            else:
+                # Mismatched inputs are single sentences in practice,
+                # so it's fine to convert them in one go.
+                self.write(_convert(m[start:end], _params(info), self.params))
+
+    def close(self):
+        if self._file.closed:
+            return
+        # RIFF chunks are padded to an even length
+        if self._data_size % 2:
+            self._file.write(b"\x00")
+        end = self._file.tell()
+        self._file.seek(4)
+        self._file.write(struct.pack("<I", end - 8))
+        self._file.seek(self._data_offset - 4)
+        self._file.write(struct.pack("<I", self._data_size))
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# HLS players want compressed segments, so each one is cut as a WAV and
+# then encoded to AAC in an MPEG-TS container.
+SEGMENT_BITRATE = "96k"
+
+
+def segment_name(prefix, ix):
+    return f"{prefix}-{ix:05d}.ts"
+
+
+def _encode_segment(wav, dest, start):
+    "Encodes `wav` to `dest`, timestamped to start `start` seconds in"
+    subprocess.run(
+        [
+            "ffmpeg",
+            "-y",
+            "-i",
+            wav,
+            "-c:a",
+            "aac",
+            "-b:a",
+            SEGMENT_BITRATE,
+            "-output_ts_offset",
+            f"{start:.3f}",
+            "-f",
+            "mpegts",
+            dest,
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        check=True,
+    )
+
+
+def write_segments(fname, prefix, done=0, segment_seconds=10.0, final=False):
+    """Cuts fixed-length segments out of the WAV `fname`, skipping the first
+    `done` (which were written by an earlier call). A trailing partial segment
+    is only written if `final`. Returns the new segment file names."""
+    info = wav_info(fname)
+    seg_bytes = int(segment_seconds * info["rate"]) * info["block_align"]
+    segments = []
+    with open(fname, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        ix = done
+        while (start := ix * seg_bytes) < info["data_size"]:
+            end = start + seg_bytes
+            if end > info["data_size"] and not final:
+                break
+            end = info["data_offset"] + min(end, info["data_size"])
+            wav = util.fresh_file(os.path.basename(prefix) + "-", ".wav")
+            try:
+                with WavWriter(wav, _params(info)) as out:
+                    for offset in range(info["data_offset"] + start, end, CHUNK_BYTES):
+                        out.write(m[offset : min(offset + CHUNK_BYTES, end)])
+                seg_name = segment_name(prefix, ix)
+                _encode_segment(wav, seg_name, ix * segment_seconds)
+            finally:
+                os.remove(wav)
+            segments.append(seg_name)
+            ix += 1
+    return segments
+
+
+def write_playlist(fname, segments, segment_seconds, final=False):
+    """Writes an HLS-style playlist for `segments`, a list of
+    `(file name, duration)` pairs. Until `final`, the playlist is left open
+    so players keep polling it for new segments."""
+    lines = [
+        "#EXTM3U",
+        "#EXT-X-VERSION:3",
+        f"#EXT-X-TARGETDURATION:{int(segment_seconds + 0.999)}",
+        "#EXT-X-MEDIA-SEQUENCE:0",
+        "#EXT-X-PLAYLIST-TYPE:EVENT",
+    ]
+    for seg, seconds in segments:
+        lines += [f"#EXTINF:{seconds:.3f},", os.path.basename(seg)]
+    if final:
+        lines.append("#EXT-X-ENDLIST")
+    tmp = f"{fname}.tmp"
+    with open(tmp, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp, fname)
+    return fname
+
+
+def _sox_stitch(files_and_silences_list):
     fnames = [
         f if type(f) is str else silence(f["silence"]) for f in files_and_silences_list
     ]
@@ -49,6 +367,25 @@ def stitch(files_and_silences_list):
     return outfile
 
 
+def stitch(files_and_silences_list):
+    """Concatenates the given files and `{"silence": seconds}` gaps into a
+    fresh WAV. Streams everything through one writer, so memory use doesn't
+    grow with the length of the list. The output takes its format from the
+    first file; anything else gets converted to match."""
+    items = list(files_and_silences_list)
+    infos = [wav_info(f) for f in items if type(f) is str]
+    if None in infos:
+        return _sox_stitch(items)
+    outfile = util.fresh_file("stitched", ".wav")
+    with WavWriter(outfile, _params(infos[0]) if infos else None) as out:
+        for el in items:
+            if type(el) is str:
+                out.write_file(el)
+            else:
+                out.write_silence(el["silence"])
+    return outfile
+
+
 def _tsec(secs):
     return srt.timedelta_to_srt_timestamp(datetime.timedelta(seconds=secs)).replace(
         ",", "."
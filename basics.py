@@ -8,12 +8,21 @@ import whisper
 from transformers import AutoTokenizer, pipeline
 
 import audio
+import registry
 import util
 
 
+def _whisper(variant="base", device="cuda"):
+    return registry.get(
+        "whisper",
+        lambda: whisper.load_model(variant, device=device),
+        variant=variant,
+        device=device,
+    )
+
+
 def _transcribe(audio_file):
-    model = whisper.load_model("base")
-    model.to("cuda")
+    model = _whisper()
     audio = whisper.load_audio(audio_file)
     audio = whisper.pad_or_trim(audio)
     mel = whisper.log_mel_spectrogram(audio).to(model.device)
@@ -26,11 +35,33 @@ def transcribe(audio_file):
     return _transcribe(audio_file).text
 
 
+def transcribe_batch(waveforms, sample_rate=whisper.audio.SAMPLE_RATE):
+    """Transcribes a list of in-memory mono waveforms with a single batched
+    decode pass. Returns the transcripts in input order."""
+    if not waveforms:
+        return []
+    model = _whisper()
+    mels = []
+    for wav in waveforms:
+        wav = torch.as_tensor(wav).float().flatten()
+        if sample_rate != whisper.audio.SAMPLE_RATE:
+            wav = torchaudio.functional.resample(
+                wav, sample_rate, whisper.audio.SAMPLE_RATE
+            )
+        mels.append(whisper.log_mel_spectrogram(whisper.pad_or_trim(wav)))
+    batch = torch.stack(mels).to(model.device)
+    return [r.text for r in whisper.decode(model, batch, whisper.DecodingOptions())]
+
+
 def speaker_diarize(audio_file):
-    model = pyannote.audio.Pipeline.from_pretrained(
-        "pyannote/speaker-diarization@2.1", use_auth_token=True
+    model = registry.get(
+        "pyannote/speaker-diarization",
+        lambda: pyannote.audio.Pipeline.from_pretrained(
+            "pyannote/speaker-diarization@2.1", use_auth_token=True
+        ).to(torch.device("cuda")),
+        variant="2.1",
+        device="cuda",
     )
-    model.to(torch.device("cuda"))
     loaded = torchaudio.load(audio_file)
     annotation = model({"waveform": loaded[0], "sample_rate": loaded[1]})
     lns = (ln.split() for ln in annotation.to_lab().splitlines())
@@ -47,7 +78,7 @@ def speaker_diarize(audio_file):
 
 
 def transcribe_to_word_srt(audio_file):
-    model = whisper.load_model("base")
+    model = _whisper()
     res = model.transcribe(audio_file, word_timestamps=True)
     ix = 0
     for seg in res["segments"]:
@@ -67,48 +98,44 @@ def transcribe_to_word_srt(audio_file):
 def transcribe_to_srt(audio_file):
     fname = util.fresh_file("transcription-", ".srt")
     writer = whisper.utils.WriteSRT("static")
-    model = whisper.load_model("base")
-    model.to("cuda")
+    model = _whisper()
     res = model.transcribe(audio_file)
     with open(fname, "w") as f:
         writer.write_result(res, f)
     return fname
 
 
-_CAPTION = None
+def _caption_model():
+    return registry.get(
+        "Salesforce/blip2-flan-t5-xl",  # "Salesforce/blip-image-captioning-base"
+        lambda: pipeline("image-to-text", model="Salesforce/blip2-flan-t5-xl"),
+    )
 
 
 def caption_image(url):
-    global _CAPTION
-    if _CAPTION is None:
-        print("Loading CAPTION model...")
-        _CAPTION = pipeline(
-            "image-to-text", model="Salesforce/blip2-flan-t5-xl"
-        )  # "Salesforce/blip-image-captioning-base"
     resp = requests.get(url, headers=util.FF_HEADERS, stream=True)
     if resp.status_code == 200:
         img = PIL.Image.open(resp.raw)
-        return _CAPTION(img)[0]["generated_text"]
+        return _caption_model()(img)[0]["generated_text"]
     return ""
 
 
-_FALCON7B = None
-
-
 def _load_falcon():
-    global _FALCON7B
-    if _FALCON7B is None:
-        print("Loading FALCON7B...")
-        text_model = "tiiuae/falcon-7b-instruct"
+    text_model = "tiiuae/falcon-7b-instruct"
+    device = util.dev_by(name="4090")
+
+    def _load():
         tokr = AutoTokenizer.from_pretrained(text_model)
-        _FALCON7B = transformers.pipeline(
+        return transformers.pipeline(
             "text-generation",
             model=text_model,
             tokenizer=tokr,
             torch_dtype=torch.bfloat16,
-            device_map=util.dev_by(name="4090"),
+            device_map=device,
         )
 
+    return registry.get(text_model, _load, variant="bfloat16", device=device)
+
 
 def _prompt_text(prompt, max_new_tokens, pipe):
     res = pipe(
@@ -122,18 +149,22 @@ def _prompt_text(prompt, max_new_tokens, pipe):
 
 
 def falcon_complete(prompt, max_new_tokens=50):
-    _load_falcon()
-    return _prompt_text(prompt, max_new_tokens, _FALCON7B)
+    return _prompt_text(prompt, max_new_tokens, _load_falcon())
 
 
-CODE_IDENTIFY = pipeline(
-    "text-classification", model="huggingface/CodeBERTa-language-id"
-)
+def _code_identify_model():
+    return registry.get(
+        "huggingface/CodeBERTa-language-id",
+        lambda: pipeline(
+            "text-classification", model="huggingface/CodeBERTa-language-id"
+        ),
+    )
 
 
 def summarize_code(code_block):
     kfn = lambda el: el["score"]
-    lang = sorted(CODE_IDENTIFY(code_block), key=kfn, reverse=True)[0]["label"]
+    langs = _code_identify_model()(code_block)
+    lang = sorted(langs, key=kfn, reverse=True)[0]["label"]
     summary = falcon_complete(
         f"Here's some code: \n```{code_block}```\n\n To summarize in a plain English sentence, it does: ",
         250,
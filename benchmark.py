@@ -0,0 +1,118 @@
+import datetime
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import timeit
+import wave
+
+import audio
+import model
+
+
+def _fake_wav(fname, seconds=3.0, rate=24000):
+    with wave.open(fname, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(rate)
+        w.writeframes(b"\x00\x00" * int(seconds * rate))
+    return fname
+
+
+def _per_call(fn, number):
+    return timeit.timeit(fn, number=number) / number
+
+
+def bench_duration_of(number=1000):
+    with tempfile.TemporaryDirectory() as tmp:
+        fname = _fake_wav(os.path.join(tmp, "bench.wav"))
+        res = {
+            "header": _per_call(lambda: audio.wav_info(fname), number),
+            "cached": _per_call(lambda: audio.duration_of(fname), number),
+        }
+        if shutil.which("ffprobe"):
+            res["ffprobe"] = _per_call(lambda: audio._ffprobe_duration(fname), 20)
+    for k, v in res.items():
+        print(f"  duration_of[{k}]: {v * 1000000:.1f}us/call")
+    return res
+
+
+def _fill_jobs(n):
+    "Roughly the shape of a real catwalk.db: blogcasts of 20 tts children each"
+    now = datetime.datetime.now()
+    inp = json.dumps({"text": "Now we resume the text.", "voice": "leo"})
+    rows = []
+    for jid in range(1, n + 1):
+        parent = None if jid % 21 == 1 else jid - (jid - 1) % 21
+        status = "STARTED" if jid > n - 50 else "COMPLETE"
+        key = 1 + jid // 500
+        rows.append((jid, key, parent, "tts", inp, "[]", status, now, now))
+    with model.DB._conn as conn:
+        conn.executemany(
+            "INSERT INTO jobs (id, api_key_id, parent_job, job_type, input,"
+            " output, status, created, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+        conn.executemany(
+            "INSERT INTO casts (job_id, script, state) VALUES (?, '[]', '{}')",
+            [(jid,) for jid in range(1, n + 1, 21)],
+        )
+
+
+def _time_lookups(n, number):
+    parents = [random.randrange(0, n // 21) * 21 + 1 for _ in range(number)]
+    keys = [1 + random.randrange(n) // 500 for _ in range(number)]
+    cases = {
+        "jobs_by_parent": lambda ix: model.jobs_by_parent(parents[ix]),
+        "all_children_finished_p": lambda ix: model.all_children_finished_p(
+            parents[ix]
+        ),
+        "jobs_by_api_key": lambda ix: model.jobs_by_api_key(keys[ix]),
+        "cast_by(job_id)": lambda ix: model.cast_by(job_id=parents[ix]),
+        "claim candidates": lambda ix: model._candidates(["tts"], 0),
+    }
+    res = {}
+    for name, fn in cases.items():
+        counter = iter(range(number))
+        res[name] = _per_call(lambda: fn(next(counter)), number)
+    return res
+
+
+def bench_job_lookups(sizes=(10000, 100000, 1000000), number=200):
+    """Times the common job lookups against tables of increasing size, with
+    and without the indexes from the schema migrations."""
+    res = {}
+    try:
+        for n in sizes:
+            with tempfile.TemporaryDirectory() as tmp:
+                model.connect(os.path.join(tmp, "bench.db"))
+                model.init()
+                _fill_jobs(n)
+                indexed = _time_lookups(n, number)
+                for idx in model._query(
+                    "SELECT name FROM sqlite_master"
+                    " WHERE type = 'index' AND name NOT LIKE 'sqlite_%'"
+                ):
+                    model.DB.exec(f"DROP INDEX {idx['name']}", ())
+                unindexed = _time_lookups(n, number)
+            res[n] = {"indexed": indexed, "unindexed": unindexed}
+            for name in indexed:
+                print(
+                    f"  {n:>9} rows {name:>24}:"
+                    f" {indexed[name] * 1000000:>10.1f}us indexed"
+                    f" {unindexed[name] * 1000000:>10.1f}us unindexed"
+                )
+    finally:
+        model.connect(model.DB_PATH)
+    return res
+
+
+BENCHMARKS = {"duration_of": bench_duration_of, "job_lookups": bench_job_lookups}
+
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or BENCHMARKS.keys():
+        print(f"{name}...")
+        BENCHMARKS[name]()
@@ -0,0 +1,101 @@
+import functools
+import os
+import re
+import tempfile
+
+import audio
+import blogcast.horrifying_hacks as hax
+import util
+
+# Seconds per syllable and seconds per pause. The per-syllable rate gets
+# recalibrated per voice from finished tts jobs; see `calibrate`.
+DEFAULT_RATE = 0.22
+PAUSES = {",": 0.25, ";": 0.3, ":": 0.3, ".": 0.45, "?": 0.45, "!": 0.45}
+MIN_CALIBRATION_SAMPLES = 5
+
+ESTIMATOR = "syllables"
+ESTIMATORS = {}
+
+_RATES = {}
+
+
+def estimator(name):
+    "Registers an estimator. Estimators take (text, voice) and return seconds."
+
+    def _register(fn):
+        ESTIMATORS[name] = fn
+        return fn
+
+    return _register
+
+
+def _syllables_in(word):
+    if word.isdigit():
+        # Roughly; "1984" is read as "nineteen eighty four"
+        return max(1, len(word)) * 2
+    groups = re.findall(r"[aeiouy]+", word)
+    n = len(groups)
+    if n > 1 and word.endswith("e") and not word.endswith(("le", "ee")):
+        n -= 1
+    return max(1, n)
+
+
+def syllables(text):
+    return sum(_syllables_in(w) for w in re.findall(r"[a-z0-9']+", text.lower()))
+
+
+def pauses(text):
+    return sum(PAUSES.get(c, 0) for c in text.rstrip(".?! "))
+
+
+def rate_for(voice):
+    return _RATES.get(voice, _RATES.get(None, DEFAULT_RATE))
+
+
+@estimator("syllables")
+def _syllable_estimate(text, voice):
+    return syllables(text) * rate_for(voice) + pauses(text)
+
+
+@estimator("espeak")
+def _espeak_estimate(text, voice):
+    with tempfile.NamedTemporaryFile(suffix=".wav") as tmp:
+        util.silent_cmd(["espeak", "-w", tmp.name, text])
+        return audio.duration_of(tmp.name)
+
+
+@functools.lru_cache(maxsize=4096)
+def estimate(text, voice=None):
+    "Returns the estimated spoken duration of `text` in seconds"
+    return ESTIMATORS[ESTIMATOR](text, voice)
+
+
+def calibrate(jobs, default_voice="leo"):
+    """Fits a per-voice seconds-per-syllable rate from finished tts jobs.
+    The `None` entry holds the rate fitted across all voices, which is what
+    voices without enough samples of their own fall back to."""
+    totals = {}
+    for job in jobs:
+        output = job["output"]
+        if not (isinstance(output, list) and output):
+            continue
+        fname = os.path.join("static", os.path.basename(output[0]))
+        if not os.path.isfile(fname):
+            continue
+        text = hax.apply(job["input"]["text"])
+        syl = syllables(text)
+        if syl == 0:
+            continue
+        voice = job["input"].get("voice") or default_voice
+        spoken = audio.duration_of(fname) - pauses(text)
+        for v in [voice, None]:
+            t = totals.setdefault(v, [0, 0.0, 0])
+            t[0] += syl
+            t[1] += spoken
+            t[2] += 1
+    _RATES.clear()
+    for voice, (syl, spoken, n) in totals.items():
+        if n >= MIN_CALIBRATION_SAMPLES and spoken > 0:
+            _RATES[voice] = spoken / syl
+    estimate.cache_clear()
+    return dict(_RATES)
@@ -1,6 +1,7 @@
 import torch
 from diffusers import DiffusionPipeline, StableDiffusionPipeline
 
+import registry
 import util
 
 # def text_to_image(
@@ -46,7 +47,12 @@ def generate_image(
     loras=[],
     gpu="1080",
 ):
-    pipe = load_model(model, loras=loras, gpu=gpu)
+    pipe = registry.get(
+        model,
+        lambda: load_model(model, loras=loras, gpu=gpu),
+        variant=tuple(loras),
+        device=gpu,
+    )
     inp = {
         "prompt": prompt,
         "negative_prompt": negative_prompt,
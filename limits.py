@@ -0,0 +1,76 @@
+import threading
+import time
+
+import model
+
+# An API key's `rate_limit` is the size of its token bucket, which refills
+# at `rate_limit` tokens per REFILL_SECONDS. Its `credits` are a balance
+# that jobs draw down; NULL credits means the key isn't metered. Spending
+# is tallied in memory and written back to api_keys by `flush`.
+REFILL_SECONDS = 60
+DEFAULT_TRIES = 5
+
+__BUCKETS = {}
+__SPENT = {}
+__LOCK = threading.Lock()
+
+
+def job_cost(job_type, job_input):
+    """Estimated cost of a job, in sentence-tries. A blogcast is charged one
+    sentence up front for the scrape. Its sentences go through `admit` again
+    when it fans out."""
+    return job_input.get("max_tries", job_input.get("tries", DEFAULT_TRIES))
+
+
+def _balance(api_key):
+    credits = api_key["credits"]
+    if credits is None or credits == "":
+        return None
+    return float(credits) - __SPENT.get(api_key["id"], 0)
+
+
+def admit(api_key, cost):
+    """Takes `cost` tokens from the key's bucket and charges `cost` credits.
+    Returns None if the job may go ahead, otherwise an HTTP status and
+    message saying why not."""
+    key_id, rate, now = api_key["id"], api_key["rate_limit"], time.time()
+    with __LOCK:
+        if rate:
+            tokens, last = __BUCKETS.get(key_id, (rate, now))
+            tokens = min(rate, tokens + (now - last) * rate / REFILL_SECONDS)
+            # Jobs bigger than the whole bucket get in once it's full, and
+            # leave the key in debt until it refills
+            if tokens < min(cost, rate):
+                __BUCKETS[key_id] = (tokens, now)
+                return 429, "rate limit exceeded"
+        balance = _balance(api_key)
+        if balance is not None and balance < cost:
+            return 402, "out of credits"
+        if rate:
+            __BUCKETS[key_id] = (tokens - cost, now)
+        __SPENT[key_id] = __SPENT.get(key_id, 0) + cost
+    return None
+
+
+def charge(api_key_id, cost):
+    "Charges credits for admitted work. A negative `cost` is a refund."
+    if api_key_id is None:
+        return
+    with __LOCK:
+        __SPENT[api_key_id] = __SPENT.get(api_key_id, 0) + cost
+
+
+def flush():
+    "Writes the credits spent since the last flush back to api_keys"
+    with __LOCK:
+        spent = dict(__SPENT)
+    if not spent:
+        return
+    model.spend_credits(spent)
+    # Only forget what we wrote once the cached balances are gone, so
+    # nothing gets counted as spent zero times in between
+    with __LOCK:
+        for key_id, amount in spent.items():
+            __SPENT[key_id] -= amount
+            if not __SPENT[key_id]:
+                del __SPENT[key_id]
@@ -6,6 +6,8 @@ import tornado
 
 import audio
 import basics
+import duration
+import limits
 import model
 import tts
 import util
@@ -33,9 +35,12 @@ class PublicJSONHandler(tornado.web.RequestHandler):
 
 
 class JSONHandler(tornado.web.RequestHandler):
+    def get_auth_token(self):
+        return self.request.headers.get("X-Auth-Token", None)
+
     def prepare(self):
-        auth_token = self.request.headers.get("X-Auth-Token", None)
-        api_key = auth_token and model.api_key_by(key=auth_token)
+        auth_token = self.get_auth_token()
+        api_key = auth_token and model.api_key_by_token(auth_token)
         if not api_key:
             self.json(
                 {"status": "looks like you're going to the shadow realm, Jimbo"}, 400
@@ -129,25 +134,124 @@ class JobsHandler(JSONHandler):
         return self.json({"jobs": model.jobs_by_api_key(self.api_key["id"])})
 
     def post(self):
-        # TODO - check if the rate and credits of the current key
         job_type = self.get_argument("type")
         if job_type is None:
             return self.json(
                 {"status": "error", "message": "request must have a `type`"}, 400
             )
-        job_input = json.loads(self.get_argument("input"))
-        if job_type is None:
+        job_input = self.get_argument("input", None)
+        job_inputs = self.get_argument("inputs", None)
+        if job_input is None and job_inputs is None:
             return self.json(
-                {"status": "error", "message": "request must have an `input`"}, 400
+                {
+                    "status": "error",
+                    "message": "request must have an `input` or `inputs`",
+                },
+                400,
             )
         parent = self.get_argument("parent_job", None)
         if parent is not None:
             parent = int(parent)
-        res = model.new_job(job_type, job_input, parent=parent)
+        priority = int(self.get_argument("priority", 0))
+        inputs = json.loads(job_inputs) if job_inputs is not None else None
+        job_input = json.loads(job_input) if inputs is None else None
+        cost = sum(limits.job_cost(job_type, inp) for inp in inputs or [job_input])
+        if refused := limits.admit(self.api_key, cost):
+            code, message = refused
+            return self.json({"status": "error", "message": message}, code)
+        if inputs is not None:
+            res = model.new_jobs(
+                job_type,
+                inputs,
+                parent=parent,
+                api_key_id=self.api_key["id"],
+                priority=priority,
+            )
+            worker.SocketServer.send_job_updates(res)
+            return self.json({"jobs": res})
+        res = model.new_job(
+            job_type,
+            job_input,
+            parent=parent,
+            api_key_id=self.api_key["id"],
+            priority=priority,
+        )
         worker.SocketServer.send_job_update(res)
         return self.json(res)
 
 
+class QueueHandler(JSONHandler):
+    def get(self):
+        return self.json({"queue": model.queue_stats(self.api_key["id"])})
+
+
+class JobEventsHandler(JSONHandler):
+    """Replays the key's job events after `since=` (or the `Last-Event-ID`
+    header). With `Accept: text/event-stream` it stays open and streams new
+    events as they happen; otherwise it long-polls for up to `timeout=`
+    seconds and returns whatever arrived. Updates to a dict-valued output
+    carry just the changed keys; see `model._output_changes`."""
+
+    KEEPALIVE_SECONDS = 15
+    MAX_WAIT_SECONDS = 60
+    WAITERS = set()
+
+    def get_auth_token(self):
+        # EventSource can't set headers, so this also takes `?token=`
+        return self.get_argument("token", None) or super().get_auth_token()
+
+    @classmethod
+    def wake(cls):
+        for waiter in cls.WAITERS:
+            waiter.set()
+
+    async def _wait(self, seconds):
+        waiter = asyncio.Event()
+        JobEventsHandler.WAITERS.add(waiter)
+        try:
+            await asyncio.wait_for(waiter.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            JobEventsHandler.WAITERS.discard(waiter)
+
+    def on_connection_close(self):
+        self.closed = True
+
+    async def get(self):
+        self.closed = False
+        since = self.get_argument("since", None)
+        if since is None:
+            since = self.request.headers.get("Last-Event-ID", 0)
+        since = int(since)
+        if "text/event-stream" in self.request.headers.get("Accept", ""):
+            return await self._stream(since)
+        timeout = min(float(self.get_argument("timeout", 30)), self.MAX_WAIT_SECONDS)
+        events = model.job_events(self.api_key["id"], since)
+        if not events and timeout > 0:
+            await self._wait(timeout)
+            events = model.job_events(self.api_key["id"], since)
+        last = events[-1]["seq"] if events else since
+        return self.json({"events": events, "last": last})
+
+    async def _stream(self, since):
+        self.set_header("Content-Type", "text/event-stream")
+        self.set_header("Cache-Control", "no-cache")
+        while not self.closed:
+            events = model.job_events(self.api_key["id"], since)
+            for ev in events:
+                self.write(f"id: {ev['seq']}\nevent: job\ndata: {json.dumps(ev)}\n\n")
+                since = ev["seq"]
+            if not events:
+                self.write(": keepalive\n\n")
+            try:
+                await self.flush()
+            except tornado.iostream.StreamClosedError:
+                return
+            if not events:
+                await self._wait(self.KEEPALIVE_SECONDS)
+
+
 class JobHandler(JSONHandler):
     def get(self, job_id):
         job = model.job_by_id(int(job_id), include_children=True)
@@ -160,22 +264,23 @@ class JobHandler(JSONHandler):
         job = model.job_by_id(int(job_id))
         if not job["api_key_id"] == self.api_key["id"]:
             return self.json({"status": "error", "message": "nope"}, 404)
-        res = model.update_job(
-            job_id, status=("CANCELLED" if not should_delete else "DELETED")
+        changed = model.cancel_jobs(
+            int(job_id), "CANCELLED" if not should_delete else "DELETED"
         )
-        if res is not None:
-            worker.SocketServer.send_job_update(res)
-            return self.json({"status": "ok"})
-        return self.json({"status": "error"}, 400)
+        worker.cancel([j["id"] for j in changed])
+        worker.SocketServer.send_job_updates(changed)
+        # Whatever was waiting on this job might be finished now
+        worker.update_parents(job)
+        return self.json({"status": "ok"})
 
     def put(self, job_id):
         job = model.job_by_id(int(job_id))
         if not job["api_key_id"] == self.api_key["id"]:
             return self.json({"status": "error", "message": "nope"}, 404)
-        res = model.update_job(job_id, status="STARTED", output={})
+        res = model.update_job(int(job_id), status="STARTED", output={})
         if res is not None:
             worker.SocketServer.send_job_update(res)
-            model.queue_job(job_id)
+            model.queue_job(int(job_id))
             return self.json({"status": "ok"})
         return self.json({"status": "error"}, 400)
 
@@ -220,7 +325,9 @@ ROUTES = [
     (r"/v1/info", InfoHandler),
     (r"/v1/job", JobsHandler),
     (r"/v1/job/([0-9]+)", JobHandler),
+    (r"/v1/queue", QueueHandler),
     (r"/v1/job/updates", worker.SocketServer),
+    (r"/v1/job/events", JobEventsHandler),
     (r"/v1/audiofile/stitch", AudioStitchHandler),
 ]
 
@@ -231,8 +338,19 @@ async def main(port):
     print("  initializing model...")
     model.init()
     model.refill_queue()
-    print("  starting worker thread...")
-    worker.make_worker().start()
+    print("  calibrating duration estimates...")
+    duration.calibrate(model.completed_jobs("tts", limit=500))
+    print("  starting worker threads...")
+    # Workers push job updates onto this loop from the start, before any
+    # websocket client has connected
+    worker.SocketServer.IOloop = tornado.ioloop.IOLoop.current()
+    for w in worker.make_workers():
+        w.start()
+    print("  flushing spent credits every 30s...")
+    tornado.ioloop.PeriodicCallback(limits.flush, 30000).start()
+    loop = tornado.ioloop.IOLoop.current()
+    model.on_job_events(lambda: loop.add_callback(JobEventsHandler.wake))
+    tornado.ioloop.PeriodicCallback(model.prune_job_events, 3600000).start()
     print(f"  static serving {static_path} ...")
     app = tornado.web.Application(
         ROUTES,
@@ -1,24 +1,112 @@
+import collections
+import contextlib
 import datetime
 import hashlib
 import json
-import queue
+import threading
+import time
 import uuid
-from queue import Queue
 
-from pytrivialsql import sqlite
+from pytrivialsql import sql, sqlite
 
-DB = sqlite.Sqlite3("catwalk.db")
+DB_PATH = "catwalk.db"
+BUSY_TIMEOUT_MS = 10000
 
-__JOB_QUEUE = Queue()
+
+class _PerThread:
+    """Stands in for a `sqlite.Sqlite3`, but hands each thread its own
+    connection so the event loop and the workers never share one. Read-only
+    instances are for lookups; under WAL they never wait on a writer."""
+
+    def __init__(self, path, read_only=False):
+        self.path = path
+        self.read_only = read_only
+        self._local = threading.local()
+
+    def _db(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite.Sqlite3(self.path)
+            db._conn.execute("PRAGMA journal_mode=WAL")
+            db._conn.execute("PRAGMA synchronous=NORMAL")
+            db._conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+            if self.read_only:
+                db._conn.execute("PRAGMA query_only=ON")
+            self._local.db = db
+        return db
+
+    def __getattr__(self, name):
+        return getattr(self._db(), name)
+
+
+def connect(path):
+    global DB, READ
+    DB = _PerThread(path)
+    READ = _PerThread(path, read_only=True)
+
+
+DB, READ = None, None
+connect(DB_PATH)
+
+# The job queue is the `jobs` table itself. Workers claim a job by taking a
+# lease on it, keep the lease alive with `heartbeat` while they work, and
+# `release` it when they're done. A job whose lease runs out (because its
+# worker died) becomes claimable again.
+LEASE_SECONDS = 60
+POLL_SECONDS = 5
+
+__QUEUE_CHANGED = threading.Condition()
+
+
+def _rows(cur):
+    cols = [d[0] for d in cur.description or []]
+    return [dict(zip(cols, row)) for row in cur.fetchall()]
+
+
+def _query(query, args=(), read_only=False):
+    with (READ if read_only else DB)._conn as conn:
+        return _rows(conn.execute(query, args))
+
+
+@contextlib.contextmanager
+def _transaction():
+    "Commits everything executed on the yielded connection together, or nothing"
+    try:
+        with DB._conn as conn:
+            # Take the write lock up front, so what we read inside the
+            # transaction can't go stale before we write
+            conn.execute("BEGIN IMMEDIATE")
+            yield conn
+    except BaseException:
+        # Jobs cached inside the transaction never made it to disk
+        invalidate_jobs()
+        raise
 
 
 def add_job(job_id):
-    __JOB_QUEUE.put(job_id)
+    "Wakes up waiting workers. The job itself is already in `jobs`."
+    with __QUEUE_CHANGED:
+        __QUEUE_CHANGED.notify_all()
 
 
 def add_jobs(job_ids):
-    for jid in job_ids:
-        add_job(jid)
+    with __QUEUE_CHANGED:
+        __QUEUE_CHANGED.notify_all()
+
+
+# Called with no arguments (from whichever thread did the write) after new
+# rows land in `job_events`. Listeners should be quick; hand off to a loop.
+_EVENT_LISTENERS = []
+
+
+def on_job_events(fn):
+    _EVENT_LISTENERS.append(fn)
+    return fn
+
+
+def _job_events_added():
+    for fn in _EVENT_LISTENERS:
+        fn()
 
 
 JOB_STATUS = [
@@ -31,6 +119,89 @@ JOB_STATUS = [
     "DELETED",
 ]
 
+FINISHED_STATUS = {"COMPLETE", "ERRORED", "CANCELLED", "DELETED"}
+CANCELLED_STATUS = {"CANCELLED", "DELETED"}
+
+_FINISHED_SQL = ", ".join(f"'{s}'" for s in sorted(FINISHED_STATUS))
+
+# Recomputes the child counters of every parent matched by the trailing
+# `WHERE` clause, which the caller supplies.
+_RECOUNT_CHILDREN = (
+    "UPDATE jobs SET"
+    " children_total = (SELECT COUNT(*) FROM jobs c WHERE c.parent_job = jobs.id),"
+    " children_finished = (SELECT COUNT(*) FROM jobs c"
+    f"  WHERE c.parent_job = jobs.id AND c.status IN ({_FINISHED_SQL})),"
+    " children_errored = (SELECT COUNT(*) FROM jobs c"
+    "  WHERE c.parent_job = jobs.id AND c.status = 'ERRORED')"
+)
+
+# Each entry is the list of statements that takes the schema from version
+# N to N+1. Append only; the current version lives in `PRAGMA user_version`.
+MIGRATIONS = [
+    [
+        "ALTER TABLE jobs ADD COLUMN lease_owner TEXT",
+        "ALTER TABLE jobs ADD COLUMN lease_expires REAL",
+    ],
+    [
+        "ALTER TABLE jobs ADD COLUMN priority INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE api_keys ADD COLUMN weight REAL NOT NULL DEFAULT 1.0",
+    ],
+    [
+        "CREATE INDEX IF NOT EXISTS jobs_by_parent ON jobs(parent_job, status)",
+        "CREATE INDEX IF NOT EXISTS jobs_by_api_key ON jobs(api_key_id, status)",
+        "CREATE INDEX IF NOT EXISTS jobs_by_type ON jobs(job_type, status, id)",
+        # Only unfinished jobs, which is what the scheduler looks at
+        "CREATE INDEX IF NOT EXISTS jobs_queued"
+        " ON jobs(job_type, api_key_id, priority, id)"
+        " WHERE status IN ('STARTED', 'RUNNING')",
+        "CREATE INDEX IF NOT EXISTS jobs_errored ON jobs(id) WHERE status = 'ERRORED'",
+        "CREATE INDEX IF NOT EXISTS casts_by_job ON casts(job_id)",
+    ],
+    [
+        "ALTER TABLE jobs ADD COLUMN children_total INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE jobs ADD COLUMN children_finished INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE jobs ADD COLUMN children_errored INTEGER NOT NULL DEFAULT 0",
+        _RECOUNT_CHILDREN
+        + " WHERE id IN (SELECT parent_job FROM jobs WHERE parent_job IS NOT NULL)",
+    ],
+    [
+        # Credits weren't enforced before this, so keys made with the old
+        # default of 0 were effectively unmetered. Keep them that way.
+        "UPDATE api_keys SET credits = NULL WHERE credits = '0'",
+    ],
+    [
+        "CREATE TABLE IF NOT EXISTS job_events ("
+        " seq INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,"
+        " job_id INTEGER NOT NULL,"
+        " api_key_id INTEGER,"
+        " event TEXT NOT NULL,"
+        " created DATETIME DEFAULT CURRENT_TIMESTAMP NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS job_events_by_api_key"
+        " ON job_events(api_key_id, seq)",
+    ],
+    [
+        "CREATE TABLE IF NOT EXISTS tts_cache ("
+        " key TEXT PRIMARY KEY NOT NULL,"
+        " files TEXT NOT NULL,"
+        " bytes INTEGER NOT NULL,"
+        " hits INTEGER NOT NULL DEFAULT 0,"
+        " used REAL NOT NULL,"
+        " created DATETIME DEFAULT CURRENT_TIMESTAMP NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS tts_cache_by_use ON tts_cache(used)",
+    ],
+]
+
+
+def migrate():
+    version = _query("PRAGMA user_version")[0]["user_version"]
+    for ix, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+        print(f"  migrating schema to version {ix}...")
+        DB.execs(
+            [("BEGIN", ())]
+            + [(stmt, ()) for stmt in statements]
+            + [(f"PRAGMA user_version = {ix}", ())]
+        )
+
 
 def init():
     DB.create(
@@ -77,6 +248,7 @@ def init():
             "FOREIGN KEY(job_id) REFERENCES jobs(id)",
         ],
     )
+    migrate()
 
 
 def hashed_key(raw_key):
@@ -91,20 +263,80 @@ def api_key_by(id=None, key=None):
     if key is not None:
         where_map["key"] = key
     try:
-        return DB.select("api_keys", "*", where=where_map)[0]
+        return READ.select("api_keys", "*", where=where_map)[0]
     except IndexError:
         return None
 
 
-def fresh_key(rate_limit, initial_credits=0, key=None):
+# Hashed token -> (expiry, api_keys row or None). Misses are cached too
+# (for less time) so a client hammering us with a bad token doesn't turn
+# into a select per request.
+API_KEY_TTL = 60
+API_KEY_MISS_TTL = 10
+API_KEY_CACHE_SIZE = 10000
+__KEY_CACHE = collections.OrderedDict()
+__KEY_CACHE_LOCK = threading.Lock()
+
+
+def api_key_by_token(raw_key):
+    """Looks up the API key for the token a client sent. Only its hash is
+    ever compared against the DB, and recent answers come from the cache."""
+    hashed, now = hashed_key(raw_key), time.time()
+    with __KEY_CACHE_LOCK:
+        hit = __KEY_CACHE.get(hashed)
+        if hit is not None and hit[0] > now:
+            __KEY_CACHE.move_to_end(hashed)
+            return hit[1] and dict(hit[1])
+    row = api_key_by(key=hashed)
+    with __KEY_CACHE_LOCK:
+        ttl = API_KEY_TTL if row else API_KEY_MISS_TTL
+        __KEY_CACHE[hashed] = (now + ttl, row)
+        __KEY_CACHE.move_to_end(hashed)
+        while len(__KEY_CACHE) > API_KEY_CACHE_SIZE:
+            __KEY_CACHE.popitem(last=False)
+    return row and dict(row)
+
+
+def invalidate_api_keys(key_ids=None, hashed_keys=()):
+    "Drops cached keys by id and/or hash. With neither, drops everything."
+    with __KEY_CACHE_LOCK:
+        if key_ids is None and not hashed_keys:
+            __KEY_CACHE.clear()
+            return
+        for hashed in hashed_keys:
+            __KEY_CACHE.pop(hashed, None)
+        for hashed, (_, row) in list(__KEY_CACHE.items()):
+            if row is not None and row["id"] in (key_ids or ()):
+                del __KEY_CACHE[hashed]
+
+
+def fresh_key(rate_limit, initial_credits=None, key=None):
     if key is None:
         key = str(uuid.uuid4())
     key_id = DB.insert(
         "api_keys", key=hashed_key(key), credits=initial_credits, rate_limit=rate_limit
     )
+    invalidate_api_keys(hashed_keys=[hashed_key(key)])
     return key, api_key_by(id=key_id)
 
 
+def revoke_key(key_id):
+    DB.delete("api_keys", where={"id": key_id})
+    invalidate_api_keys([key_id])
+
+
+def spend_credits(spent):
+    "Takes {key_id: amount} off the credits of each metered key"
+    with _transaction() as conn:
+        conn.executemany(
+            "UPDATE api_keys SET credits = CAST(credits AS REAL) - ?,"
+            " updated = CURRENT_TIMESTAMP"
+            " WHERE id = ? AND credits IS NOT NULL AND credits != ''",
+            [(amount, key_id) for key_id, amount in spent.items()],
+        )
+    invalidate_api_keys(list(spent))
+
+
 def _transform_job(raw_job):
     raw_job["input"] = json.loads(raw_job["input"])
     if outp := raw_job["output"]:
@@ -116,85 +348,284 @@ def _transform_job(raw_job):
 
 
 def all_jobs():
-    return DB.select(
+    return READ.select(
         "jobs", "*", where=("NOT", {"status": "DELETED"}), transform=_transform_job
     )
 
 
 def jobs_by_api_key(api_key_id):
-    return DB.select(
+    return READ.select(
         "jobs",
         "*",
-        where=("NOT", {"status": "DELETED", "api_key_id": api_key_id}),
+        where=("AND", {"api_key_id": api_key_id}, ("NOT", {"status": "DELETED"})),
+        transform=_transform_job,
+    )
+
+
+def completed_jobs(job_type, limit=None):
+    return READ.select(
+        "jobs",
+        "*",
+        where={"job_type": job_type, "status": "COMPLETE"},
+        order_by="id DESC",
+        limit=limit,
         transform=_transform_job,
     )
 
 
 def jobs_by_id(ids):
-    return DB.select("jobs", "*", where={"id": set(ids)}, transform=_transform_job)
+    return READ.select("jobs", "*", where={"id": set(ids)}, transform=_transform_job)
+
+
+# Parsed jobs by id. Every write to `jobs` in this module either refreshes
+# or invalidates the rows it touches, so `job_by_id` can skip the select
+# and the JSON parsing. Callers get shallow copies; don't mutate `input` or
+# `output` in place.
+#
+# Writes refresh the cache from inside their transaction, so they land in
+# the same order as the commits. A miss in `job_by_id` only fills the cache
+# if nothing was cached or invalidated since the miss; otherwise the row it
+# read might already be stale.
+#
+# None of that sees writes from other processes sharing the database, so
+# entries also expire JOB_CACHE_TTL seconds after the row was read.
+JOB_CACHE_SIZE = 10000
+JOB_CACHE_TTL = 5.0
+__JOB_CACHE = collections.OrderedDict()
+__JOB_CACHE_LOCK = threading.Lock()
+__JOB_CACHE_WRITES = 0
+
+
+def _put_job(job, read_at):
+    "Call with __JOB_CACHE_LOCK held"
+    __JOB_CACHE[job["id"]] = (read_at + JOB_CACHE_TTL, job)
+    __JOB_CACHE.move_to_end(job["id"])
+    while len(__JOB_CACHE) > JOB_CACHE_SIZE:
+        __JOB_CACHE.popitem(last=False)
+
+
+def _cache_job(job):
+    "Write-through for a row we just wrote. Call inside the write's transaction."
+    global __JOB_CACHE_WRITES
+    with __JOB_CACHE_LOCK:
+        __JOB_CACHE_WRITES += 1
+        _put_job(job, time.time())
+    return dict(job)
+
+
+def invalidate_jobs(job_ids=None):
+    "Drops the given jobs from the cache, or all of them if `job_ids` is None"
+    global __JOB_CACHE_WRITES
+    with __JOB_CACHE_LOCK:
+        __JOB_CACHE_WRITES += 1
+        if job_ids is None:
+            __JOB_CACHE.clear()
+        for jid in job_ids or []:
+            __JOB_CACHE.pop(jid, None)
 
 
 def job_by_id(job_id, include_children=False):
-    job = DB.select("jobs", "*", where={"id": job_id}, transform=_transform_job)[0]
+    job, now = None, time.time()
+    with __JOB_CACHE_LOCK:
+        hit = __JOB_CACHE.get(job_id)
+        if hit is not None and hit[0] > now:
+            __JOB_CACHE.move_to_end(job_id)
+            job = dict(hit[1])
+        writes = __JOB_CACHE_WRITES
+    if job is None:
+        job = READ.select("jobs", "*", where={"id": job_id}, transform=_transform_job)[
+            0
+        ]
+        with __JOB_CACHE_LOCK:
+            if writes == __JOB_CACHE_WRITES:
+                _put_job(job, now)
+        job = dict(job)
     if include_children:
         job["children"] = jobs_by_parent(job_id)
     return job
 
 
 def all_children_finished_p(job_id):
-    children_status = DB.select("jobs", ["status"], where={"parent_job": job_id})
-    if {c["status"] for c in children_status} - {
-        "COMPLETE",
-        "ERRORED",
-        "CANCELLED",
-        "DELETED",
-    }:
-        return False
-    return True
+    counts = READ.select(
+        "jobs", ["children_total", "children_finished"], where={"id": job_id}
+    )[0]
+    return counts["children_finished"] >= counts["children_total"]
 
 
 def jobs_by_parent(job_id):
-    return DB.select(
+    return READ.select(
         "jobs", "*", where={"parent_job": job_id}, transform=_transform_job
     )
 
 
-def refill_queue():
-    """Meant to be run on startup. It re-populates the job queue with
-    jobs still on disk, but not yet comlpeted"""
-    queuable = DB.select(
-        "jobs",
-        "*",
-        where=(
-            "NOT",
-            {"status": {"COMPLETE", "CANCELLED", "WAITING_FOR_CHILDREN", "DELETED"}},
-        ),
-        transform=_transform_job,
+def _log_events(conn, events):
+    "Appends (job_id, api_key_id, event) rows to `job_events`"
+    conn.executemany(
+        "INSERT INTO job_events (job_id, api_key_id, event) VALUES (?, ?, ?)",
+        [(jid, key, json.dumps(event)) for jid, key, event in events],
     )
-    for job in queuable:
-        if job["status"] == "ERRORED":
-            update_job(job["id"], status="STARTED")
-        add_job(job["id"])
 
 
-def new_job(job_type, job_input, parent=None):
+def _created_event(jid, job_type, parent, job_input):
+    return {
+        "type": "created",
+        "id": jid,
+        "job_type": job_type,
+        "parent_job": parent,
+        "status": "STARTED",
+        "input": job_input,
+    }
+
+
+def job_events(api_key_id, since=0, limit=500):
+    "The key's job events after sequence number `since`, oldest first"
+    return [
+        {"seq": row["seq"], **json.loads(row["event"])}
+        for row in _query(
+            "SELECT seq, event FROM job_events"
+            " WHERE api_key_id = ? AND seq > ? ORDER BY seq LIMIT ?",
+            (api_key_id, since, limit),
+            read_only=True,
+        )
+    ]
+
+
+def prune_job_events(keep_days=7):
+    DB.exec(
+        "DELETE FROM job_events WHERE created < datetime('now', ?)",
+        (f"-{keep_days} days",),
+    )
+
+
+def refill_queue():
+    """Meant to be run on startup. Gives errored jobs another go. Everything
+    else that isn't finished is claimable straight out of `jobs` already."""
+    with _transaction() as conn:
+        parents = conn.execute(
+            "SELECT DISTINCT parent_job FROM jobs"
+            " WHERE status = 'ERRORED' AND parent_job IS NOT NULL"
+        ).fetchall()
+        restarted = conn.execute(
+            "UPDATE jobs SET status = 'STARTED', updated = ? WHERE status = 'ERRORED'"
+            " RETURNING id, api_key_id, job_type, parent_job",
+            (datetime.datetime.now(),),
+        ).fetchall()
+        conn.executemany(_RECOUNT_CHILDREN + " WHERE id = ?", parents)
+        _log_events(
+            conn,
+            [
+                (
+                    jid,
+                    key,
+                    {
+                        "type": "updated",
+                        "id": jid,
+                        "job_type": jtype,
+                        "parent_job": parent,
+                        "status": "STARTED",
+                    },
+                )
+                for jid, key, jtype, parent in restarted
+            ],
+        )
+    invalidate_jobs()
+    add_jobs([])
+    if restarted:
+        _job_events_added()
+
+
+def new_job(job_type, job_input, parent=None, api_key_id=None, priority=0):
     now = datetime.datetime.now()
     props = {
         "job_type": job_type,
         "input": json.dumps(job_input),
+        "priority": priority,
         "created": now,
         "updated": now,
     }
     if parent is not None:
-        assert job_by_id(parent), f"No such job: {parent}"
+        parent_job = job_by_id(parent)
+        assert parent_job, f"No such job: {parent}"
         props["parent_job"] = parent
-    job_id = DB.insert("jobs", **props)
-    job = job_by_id(job_id)
+        if api_key_id is None:
+            api_key_id = parent_job["api_key_id"]
+    if api_key_id is not None:
+        props["api_key_id"] = api_key_id
+    query, args = sql.insert_q("jobs", **props)
+    with _transaction() as conn:
+        (row,) = _rows(conn.execute(query + " RETURNING *", args))
+        if parent is not None:
+            conn.execute(
+                "UPDATE jobs SET children_total = children_total + 1 WHERE id = ?",
+                (parent,),
+            )
+        event = _created_event(row["id"], job_type, parent, job_input)
+        _log_events(conn, [(row["id"], api_key_id, event)])
+        if parent is not None:
+            invalidate_jobs([parent])
+        job = _cache_job(_transform_job(row))
     add_job(job["id"])
+    _job_events_added()
     return job
 
 
-def update_job(job_id, input=None, output=None, status=None):
+def new_jobs(job_type, job_inputs, parent=None, api_key_id=None, priority=0):
+    """Creates one job per entry in `job_inputs`, all in a single transaction.
+    Returns the new jobs in the same order as their inputs."""
+    if not job_inputs:
+        return []
+    now = datetime.datetime.now()
+    if parent is not None:
+        parent_job = job_by_id(parent)
+        assert parent_job, f"No such job: {parent}"
+        if api_key_id is None:
+            api_key_id = parent_job["api_key_id"]
+    rows = [
+        (job_type, json.dumps(inp), priority, parent, api_key_id, now, now)
+        for inp in job_inputs
+    ]
+    with _transaction() as conn:
+        conn.executemany(
+            "INSERT INTO jobs (job_type, input, priority, parent_job, api_key_id,"
+            " created, updated) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+        # We hold the write lock, so our rows are the last len(rows) ids
+        (last,) = conn.execute(
+            "SELECT seq FROM sqlite_sequence WHERE name = 'jobs'"
+        ).fetchone()
+        if parent is not None:
+            conn.execute(
+                "UPDATE jobs SET children_total = children_total + ? WHERE id = ?",
+                (len(rows), parent),
+            )
+        first = last - len(rows) + 1
+        _log_events(
+            conn,
+            [
+                (jid, api_key_id, _created_event(jid, job_type, parent, inp))
+                for jid, inp in enumerate(job_inputs, start=first)
+            ],
+        )
+        if parent is not None:
+            invalidate_jobs([parent])
+        jobs = [
+            _cache_job(_transform_job(job))
+            for job in _rows(
+                conn.execute(
+                    "SELECT * FROM jobs WHERE id BETWEEN ? AND ? ORDER BY id",
+                    (first, last),
+                )
+            )
+        ]
+    add_jobs([job["id"] for job in jobs])
+    _job_events_added()
+    return jobs
+
+
+def update_job(job_id, input=None, output=None, status=None, unless_status=()):
+    """Updates the job and returns it. If the job's current status is in
+    `unless_status`, nothing changes and this returns None."""
     update = {}
     if input is not None:
         update["input"] = json.dumps(input)
@@ -205,33 +636,298 @@ def update_job(job_id, input=None, output=None, status=None):
         update["status"] = status
     if update:
         update["updated"] = datetime.datetime.now()
-        DB.update("jobs", update, where={"id": job_id})
-        return job_by_id(job_id)
+        query, args = sql.update_q("jobs", where={"id": job_id}, **update)
+        with _transaction() as conn:
+            old_status, parent, old_output = conn.execute(
+                "SELECT status, parent_job, output FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+            if old_status in unless_status:
+                return None
+            (row,) = _rows(conn.execute(query + " RETURNING *", args))
+            if status is not None and parent is not None:
+                if _count_transition(conn, parent, old_status, status):
+                    invalidate_jobs([parent])
+            event = {
+                "type": "updated",
+                "id": job_id,
+                "job_type": row["job_type"],
+                "parent_job": parent,
+                "status": row["status"],
+            }
+            if input is not None:
+                event["input"] = input
+            if output is not None:
+                event.update(_output_changes(old_output, output))
+            _log_events(conn, [(job_id, row["api_key_id"], event)])
+            job = _cache_job(_transform_job(row))
+        _job_events_added()
+        return job
     return None
 
 
+def _output_changes(old_raw, new):
+    """The part of an update event that describes the new output. When both
+    outputs are dicts, only the keys that changed go in (as `output_changes`,
+    plus `output_removed` for keys that went away), so that a blogcast
+    finishing sentence by sentence doesn't log its whole script every time.
+    Anything else is logged whole as `output`."""
+    old = json.loads(old_raw) if old_raw else None
+    if not (isinstance(old, dict) and isinstance(new, dict)):
+        return {"output": new}
+    res = {"output_changes": {k: v for k, v in new.items() if old.get(k) != v}}
+    if removed := [k for k in old if k not in new]:
+        res["output_removed"] = removed
+    return res
+
+
+def _count_transition(conn, parent, old_status, new_status):
+    "Keeps the parent's child counters in step with one child's status change"
+    finished = (new_status in FINISHED_STATUS) - (old_status in FINISHED_STATUS)
+    errored = (new_status == "ERRORED") - (old_status == "ERRORED")
+    if finished or errored:
+        conn.execute(
+            "UPDATE jobs SET children_finished = children_finished + ?,"
+            " children_errored = children_errored + ? WHERE id = ?",
+            (finished, errored, parent),
+        )
+        return True
+    return False
+
+
+def cancel_jobs(job_id, status="CANCELLED"):
+    """Cancels the job and every unfinished job below it in one go. With
+    status="DELETED" it shreds the whole tree, finished or not. Returns
+    the jobs that changed."""
+    assert status in CANCELLED_STATUS
+    args = [job_id, status, datetime.datetime.now()]
+    which = ""
+    if status == "CANCELLED":
+        which = f" AND (id = ? OR status NOT IN ({_FINISHED_SQL}))"
+        args.append(job_id)
+    with _transaction() as conn:
+        changed = conn.execute(
+            "WITH RECURSIVE tree(id) AS ("
+            " SELECT ? UNION ALL"
+            " SELECT jobs.id FROM jobs JOIN tree ON jobs.parent_job = tree.id)"
+            " UPDATE jobs SET status = ?, updated = ?"
+            f" WHERE id IN tree{which}"
+            " RETURNING id, api_key_id, job_type, parent_job",
+            args,
+        ).fetchall()
+        parents = {parent for _, _, _, parent in changed if parent is not None}
+        conn.executemany(
+            _RECOUNT_CHILDREN + " WHERE id = ?", [(parent,) for parent in parents]
+        )
+        _log_events(
+            conn,
+            [
+                (
+                    jid,
+                    key,
+                    {
+                        "type": "updated",
+                        "id": jid,
+                        "job_type": jtype,
+                        "parent_job": parent,
+                        "status": status,
+                    },
+                )
+                for jid, key, jtype, parent in changed
+            ],
+        )
+    ids = [jid for jid, _, _, _ in changed]
+    invalidate_jobs(ids + list(parents))
+    _job_events_added()
+    return jobs_by_id(ids) if ids else []
+
+
 def queue_job(job_id):
     assert job_by_id(job_id), f"No such job: {job_id}"
+    DB.update(
+        "jobs", {"lease_owner": None, "lease_expires": None}, where={"id": job_id}
+    )
+    invalidate_jobs([job_id])
     add_job(job_id)
 
 
-def pull_job():
-    jid = __JOB_QUEUE.get()
-    job = job_by_id(jid)
-    if not job["status"] in {"CANCELLED", "DELETED"}:
+def _claimable(table="jobs"):
+    return (
+        f"{table}.status IN ('STARTED', 'RUNNING')"
+        f" AND ({table}.lease_expires IS NULL OR {table}.lease_expires < ?)"
+    )
+
+
+# Virtual time each API key has used up, in jobs / weight. The scheduler
+# always serves the key that's furthest behind, so a key with a 400 sentence
+# blogcast queued gets the same turns as a key with a single tts job.
+__USAGE = {}
+__VCLOCK = 0.0
+__USAGE_LOCK = threading.Lock()
+
+
+def _candidates(job_types, now):
+    """The next job each API key would run: highest priority first, then
+    children of blogcasts that are already underway, then oldest."""
+    marks = ", ".join("?" for _ in job_types)
+    in_progress = "COALESCE(p.status = 'WAITING_FOR_CHILDREN', 0)"
+    return _query(
+        "SELECT id, api_key_id, priority, weight FROM ("
+        f" SELECT j.id, j.api_key_id, j.priority, COALESCE(k.weight, 1.0) AS weight,"
+        " ROW_NUMBER() OVER ("
+        "  PARTITION BY j.api_key_id"
+        f"  ORDER BY j.priority DESC, {in_progress} DESC, j.id"
+        " ) AS rank"
+        " FROM jobs j"
+        " LEFT JOIN jobs p ON p.id = j.parent_job"
+        " LEFT JOIN api_keys k ON k.id = j.api_key_id"
+        f" WHERE j.job_type IN ({marks}) AND {_claimable('j')}"
+        ") WHERE rank = 1",
+        (*job_types, now),
+    )
+
+
+def _fair_order(candidates):
+    with __USAGE_LOCK:
+        for c in candidates:
+            # Keys that have been idle don't get to bank their share
+            key = c["api_key_id"]
+            __USAGE[key] = max(__USAGE.get(key, __VCLOCK), __VCLOCK)
+        return sorted(candidates, key=lambda c: (__USAGE[c["api_key_id"]], c["id"]))
+
+
+def _charge(candidate):
+    global __VCLOCK
+    with __USAGE_LOCK:
+        key = candidate["api_key_id"]
+        __VCLOCK = __USAGE[key]
+        __USAGE[key] += 1.0 / max(candidate["weight"], 0.001)
+
+
+def claim_job(job_types, owner):
+    """Atomically leases the next job of one of `job_types` to `owner`,
+    picking between API keys by weighted fair share. Cancelled and deleted
+    jobs are never claimable."""
+    now = time.time()
+    for candidate in _fair_order(_candidates(job_types, now)):
+        with _transaction() as conn:
+            claimed = _rows(
+                conn.execute(
+                    f"UPDATE jobs SET lease_owner=?, lease_expires=?"
+                    f" WHERE id=? AND {_claimable()} RETURNING *",
+                    (owner, now + LEASE_SECONDS, candidate["id"], now),
+                )
+            )
+            if not claimed:
+                # Another worker got there first; try the next key
+                continue
+            job = _cache_job(_transform_job(claimed[0]))
+        _charge(candidate)
         return job
-    return pull_job()
+    return None
 
 
-def get_job():
-    try:
-        jid = __JOB_QUEUE.get_nowait()
-        job = job_by_id(jid)
-        if not job["status"] in {"CANCELLED", "DELETED"}:
+def claim_batch(owner, api_key_id, job_type, match, limit):
+    """Leases up to `limit` more claimable jobs of `job_type` from the same
+    API key whose inputs agree on every field in `match`, which maps input
+    field -> (value, default used when the field is missing)."""
+    if limit < 1:
+        return []
+    now = time.time()
+    same = " AND ".join(
+        f"COALESCE(json_extract(input, '$.{field}'), ?) = ?" for field in match
+    )
+    same_args = [arg for value, default in match.values() for arg in (default, value)]
+    with _transaction() as conn:
+        claimed = _rows(
+            conn.execute(
+                "UPDATE jobs SET lease_owner=?, lease_expires=? WHERE id IN ("
+                " SELECT id FROM jobs"
+                f" WHERE job_type = ? AND api_key_id IS ? AND {_claimable()}"
+                f" AND {same} ORDER BY priority DESC, id LIMIT ?"
+                ") RETURNING *",
+                (
+                    owner,
+                    now + LEASE_SECONDS,
+                    job_type,
+                    api_key_id,
+                    now,
+                    *same_args,
+                    limit,
+                ),
+            )
+        )
+        jobs = [_cache_job(_transform_job(job)) for job in claimed]
+    if claimed:
+        weight = _query(
+            "SELECT weight FROM api_keys WHERE id IS ?", (api_key_id,), read_only=True
+        )
+        for _ in claimed:
+            _charge(
+                {
+                    "api_key_id": api_key_id,
+                    "weight": weight[0]["weight"] if weight else 1.0,
+                }
+            )
+    return sorted(jobs, key=lambda job: job["id"])
+
+
+def queue_stats(api_key_id=None):
+    "Queue depth and wait times in seconds, per API key"
+    where, args = "", ()
+    if api_key_id is not None:
+        where, args = " AND api_key_id = ?", (api_key_id,)
+    waited = "(julianday('now', 'localtime') - julianday(created)) * 86400"
+    return _query(
+        "SELECT api_key_id,"
+        " SUM(status = 'STARTED') AS queued,"
+        " SUM(status = 'RUNNING') AS running,"
+        f" MAX(CASE WHEN status = 'STARTED' THEN {waited} END) AS max_wait,"
+        f" AVG(CASE WHEN status = 'STARTED' THEN {waited} END) AS mean_wait"
+        " FROM jobs WHERE status IN ('STARTED', 'RUNNING')"
+        f"{where} GROUP BY api_key_id",
+        args,
+        read_only=True,
+    )
+
+
+def heartbeat(job_id, owner):
+    "Extends `owner`s lease on the job. Returns False if it's no longer theirs."
+    renewed = _query(
+        "UPDATE jobs SET lease_expires=? WHERE id=? AND lease_owner=? RETURNING id",
+        (time.time() + LEASE_SECONDS, job_id, owner),
+    )
+    invalidate_jobs([job_id])
+    return bool(renewed)
+
+
+def release_job(job_id, owner):
+    _query(
+        "UPDATE jobs SET lease_owner=NULL, lease_expires=NULL"
+        " WHERE id=? AND lease_owner=?",
+        (job_id, owner),
+    )
+    invalidate_jobs([job_id])
+
+
+def pull_job(job_types, owner):
+    "Blocks until a job of one of `job_types` can be claimed for `owner`"
+    while True:
+        if (job := claim_job(job_types, owner)) is not None:
             return job
-        return get_job()
-    except queue.Empty:
-        return None
+        with __QUEUE_CHANGED:
+            # Time out every so often to pick up expired leases and
+            # jobs queued by other processes
+            __QUEUE_CHANGED.wait(POLL_SECONDS)
+
+
+def wait_for_jobs(timeout):
+    "Blocks until new jobs might be claimable, or `timeout` seconds pass"
+    with __QUEUE_CHANGED:
+        __QUEUE_CHANGED.wait(timeout)
+
+
+def get_job(job_types, owner):
+    return claim_job(job_types, owner)
 
 
 def job_to_cast(job):
@@ -254,7 +950,7 @@ def cast_by(cast_id=None, job_id=None):
         where["id"] = cast_id
     if job_id is not None:
         where["job_id"] = job_id
-    return DB.select("casts", "*", where=where, transform=_transform_cast)[0]
+    return READ.select("casts", "*", where=where, transform=_transform_cast)[0]
 
 
 def _db_proc_process_jobs_to_casts():
@@ -262,3 +958,42 @@ def _db_proc_process_jobs_to_casts():
     for job in cast_jobs:
         print(f"Converting job {job['id']} ...")
         job_to_cast(job)
+
+
+def tts_cache_hit(key):
+    "Returns the cached files for `key` (marking them used), or None"
+    with DB._conn as conn:
+        row = conn.execute(
+            "UPDATE tts_cache SET used = ?, hits = hits + 1 WHERE key = ?"
+            " RETURNING files",
+            (time.time(), key),
+        ).fetchone()
+    return row and json.loads(row[0])
+
+
+def tts_cache_put(key, files, size):
+    with DB._conn as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO tts_cache (key, files, bytes, used)"
+            " VALUES (?, ?, ?, ?)",
+            (key, json.dumps(files), size, time.time()),
+        )
+
+
+def tts_cache_drop(key):
+    DB.delete("tts_cache", where={"key": key})
+
+
+def tts_cache_evict(max_bytes):
+    """Drops the least recently used entries until the rest fit in
+    `max_bytes`. Returns the files that are no longer indexed."""
+    with _transaction() as conn:
+        evicted = conn.execute(
+            "DELETE FROM tts_cache WHERE key IN ("
+            " SELECT key FROM ("
+            "  SELECT key, SUM(bytes) OVER (ORDER BY used DESC, key) AS running"
+            "  FROM tts_cache)"
+            " WHERE running > ?) RETURNING files",
+            (max_bytes,),
+        ).fetchall()
+    return [f for (files,) in evicted for f in json.loads(files)]
@@ -0,0 +1,121 @@
+import collections
+import threading
+import time
+
+import torch
+
+# Models are kept resident until the sum of their estimated sizes exceeds
+# this many bytes, at which point the least recently used ones get dropped.
+# `None` means "never evict".
+MEMORY_BUDGET = 24 * 1024**3
+
+_LOCK = threading.RLock()
+_MODELS = collections.OrderedDict()
+# Key -> lock held by whoever is loading that model right now
+_LOADING = {}
+_STATS = {"hits": 0, "misses": 0, "evictions": 0, "load_seconds": 0.0}
+
+
+def _tensor_bytes(module):
+    return sum(
+        t.numel() * t.element_size()
+        for t in list(module.parameters()) + list(module.buffers())
+    )
+
+
+def _size_of(thing):
+    "Best-effort estimate of the memory held by a loaded model, in bytes"
+    if isinstance(thing, torch.nn.Module):
+        return _tensor_bytes(thing)
+    components = getattr(thing, "components", None)
+    if isinstance(components, dict):
+        # diffusers pipelines
+        return sum(_size_of(c) for c in components.values())
+    inner = getattr(thing, "model", None)
+    if isinstance(inner, torch.nn.Module):
+        # transformers pipelines
+        return _tensor_bytes(inner)
+    return 0
+
+
+def _resident_bytes():
+    return sum(m["size"] for m in _MODELS.values())
+
+
+def _evict(keep=None):
+    if MEMORY_BUDGET is None:
+        return
+    while _resident_bytes() > MEMORY_BUDGET:
+        victim = next((k for k in _MODELS if k != keep), None)
+        if victim is None:
+            return
+        print(f"Evicting {victim} from model registry...")
+        del _MODELS[victim]
+        _STATS["evictions"] += 1
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def _hit(key):
+    "Call with _LOCK held"
+    _STATS["hits"] += 1
+    _MODELS.move_to_end(key)
+    return _MODELS[key]["model"]
+
+
+def get(name, loader, variant=None, device=None):
+    """Returns the model keyed by (name, variant, device), calling `loader`
+    to load it on first use. Loaded models stay resident until evicted.
+
+    Loads happen outside of _LOCK, so a slow load only holds up callers
+    waiting on that same model."""
+    key = (name, variant, device)
+    with _LOCK:
+        if key in _MODELS:
+            return _hit(key)
+        loading = _LOADING.setdefault(key, threading.Lock())
+    with loading:
+        with _LOCK:
+            # Someone else may have loaded it while we waited our turn
+            if key in _MODELS:
+                return _hit(key)
+            _STATS["misses"] += 1
+        print(f"Loading {key}...")
+        start = time.time()
+        model = loader()
+        elapsed = time.time() - start
+        with _LOCK:
+            _STATS["load_seconds"] += elapsed
+            _MODELS[key] = {"model": model, "size": _size_of(model), "load": elapsed}
+            _evict(keep=key)
+            # If a load fails, its lock stays put so that retries still
+            # take turns
+            _LOADING.pop(key, None)
+        return model
+
+
+def drop(name=None):
+    "Evicts every resident model, or just the ones called `name`"
+    with _LOCK:
+        for key in [k for k in _MODELS if name is None or k[0] == name]:
+            del _MODELS[key]
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+
+def stats():
+    with _LOCK:
+        return {
+            **_STATS,
+            "resident_bytes": _resident_bytes(),
+            "resident": [
+                {
+                    "name": name,
+                    "variant": variant,
+                    "device": device,
+                    "bytes": m["size"],
+                    "load_seconds": m["load"],
+                }
+                for (name, variant, device), m in _MODELS.items()
+            ],
+        }
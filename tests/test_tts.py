@@ -0,0 +1,45 @@
+import os
+
+import pytest
+
+import tts
+
+
+@pytest.fixture(autouse=True)
+def static_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("static")
+
+
+def test_batch_on_cpu_backend():
+    texts = ["Hello there.", "This is a slightly longer sentence, for variety."]
+    res = tts.text_to_wavs_batch(texts, k=2, tries=3, backend=tts.CPUBackend())
+    assert len(res) == len(texts)
+    for paths in res:
+        assert len(paths) == 2
+        assert all(os.path.isfile(p) for p in paths)
+
+
+def test_each_text_is_handed_over_as_it_settles():
+    done = []
+    res = tts.text_to_wavs_batch(
+        ["One.", "Two.", "Three."],
+        k=1,
+        backend=tts.CPUBackend(),
+        on_done=lambda ix, paths: done.append((ix, paths)),
+    )
+    assert sorted(done) == [(ix, paths) for ix, paths in enumerate(res)]
+
+
+def test_cancelled_texts_come_back_empty():
+    res = tts.text_to_wavs_batch(
+        ["Keep me.", "Drop me."],
+        k=1,
+        backend=tts.CPUBackend(),
+        cancelled=lambda ix: ix == 1,
+    )
+    assert res[0] and res[1] is None
+    with pytest.raises(tts.Cancelled):
+        tts.text_to_wavs_batch(
+            ["Drop me."], k=1, backend=tts.CPUBackend(), cancelled=lambda ix: True
+        )
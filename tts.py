@@ -1,34 +1,57 @@
+import concurrent.futures
+import contextlib
+import hashlib
+import itertools
+import os
 import string
-import tempfile
+import threading
+import time
 
 import editdistance
+import torch
 import torchaudio
 import tortoise.utils.audio as audio
 from tortoise.api import TextToSpeech
 
-import audio as autil
 import basics
+import duration
 import util
 
 print("Loading TTS...")
 _TTS = None
-_VOICES = {}
 
+SAMPLE_RATE = 24000
+DEFAULT_VOICE = "leo"
+DEFAULT_PRESET = "fast"
 
-def init_voices():
-    global _VOICES
-    if not _VOICES:
-        _VOICES = {
-            voice: audio.load_voices([voice], extra_voice_dirs=["extra-voices"])
-            for voice in audio.get_voices(["extra-voices"])
-        }
+VOICE_DIRS = ["extra-voices"]
+LATENT_DIR = "voice-latents"
+
+# With PIPELINE on, each try's candidates are scored on _SCORER while the
+# next try generates. A generation that has already started can't be called
+# off, so when the first try passes (the usual case) every sentence pays for
+# a second one. That only comes out ahead on backends where scoring costs
+# about as much as generating, which tortoise + whisper doesn't, hence off
+# by default. TIMINGS accumulates seconds per stage across calls.
+PIPELINE = False
+_SCORER = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="tts-score")
+TIMINGS = {}
+_TIMINGS_LOCK = threading.Lock()
+
+# Conditioning latents of the voices used so far. Voices are only loaded
+# (and their latents computed, or read back from LATENT_DIR) on first use.
+_LATENTS = {}
+_LATENTS_LOCK = threading.Lock()
+
+
+class Cancelled(Exception):
+    "Raised once everything a text_to_wavs call was reading has been cancelled"
 
 
 def init():
     global _TTS
     if _TTS is None:
         _TTS = TextToSpeech(kv_cache=True, half=True)
-    init_voices()
 
 
 def _clean(s):
@@ -36,55 +59,281 @@ def _clean(s):
 
 
 def get_voices():
-    init_voices()
-    return sorted(_VOICES.keys())
+    "Lists voices from their directories, without loading any of them"
+    return sorted(audio.get_voices(VOICE_DIRS).keys())
+
+
+def _digest(files):
+    h = hashlib.sha256()
+    for fname in sorted(files):
+        h.update(os.path.basename(fname).encode("utf-8"))
+        with open(fname, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()[:16]
+
+
+def _load_latents(voice):
+    files = audio.get_voices(VOICE_DIRS)[voice]
+    cached = os.path.join(LATENT_DIR, f"{voice}-{_digest(files)}.pth")
+    if os.path.isfile(cached):
+        return torch.load(cached)
+    samples, latents = audio.load_voices([voice], extra_voice_dirs=VOICE_DIRS)
+    if latents is None:
+        latents = _TTS.get_conditioning_latents(samples)
+    os.makedirs(LATENT_DIR, exist_ok=True)
+    torch.save(latents, cached)
+    return latents
+
+
+def latents_for(voice):
+    with _LATENTS_LOCK:
+        if voice not in _LATENTS:
+            _LATENTS[voice] = _load_latents(voice)
+        return _LATENTS[voice]
 
 
 def _save(arr, voice):
     fname = util.fresh_file(f"audio-{voice}-", ".wav")
-    torchaudio.save(fname, arr.squeeze(0).cpu(), 24000)
+    torchaudio.save(fname, arr.squeeze(0).cpu(), SAMPLE_RATE)
     return fname
 
 
-def _estimate_duration(text):
-    with tempfile.NamedTemporaryFile() as tmp:
-        util.silent_cmd(["espeak", "-w", tmp.name, text])
-        return autil.duration_of(tmp.name)
+def _duration_distance(arr, estimated):
+    return abs(estimated - arr.shape[-1] / SAMPLE_RATE)
 
 
-def _duration_distance(fname, estimated):
-    return abs(estimated - (autil.duration_of(fname)))
+def _transcript_distance(transcript, original):
+    return editdistance.distance(_clean(original), _clean(transcript))
 
 
-def _transcript_distance(fname, original):
-    return editdistance.distance(_clean(original), _clean(basics.transcribe(fname)))
+def _score(gens, texts, estimates, backend):
+    """Scores every candidate from one generation as a single batch. `texts`
+    and `estimates` line up with `gens`."""
+    transcripts = backend.transcribe([g.squeeze() for g in gens])
+    return [
+        (_transcript_distance(transcript, text), _duration_distance(g, estimated))
+        for g, transcript, text, estimated in zip(gens, transcripts, texts, estimates)
+    ]
 
 
-def text_to_wavs(text, voice=None, k=3, threshold=0.2, tries=5):
-    init()
-    assert 10 >= k >= 1, f"k must be between 1 and 10. got {k}"
-    if voice is None:
-        voice = "leo"
-    samples, latents = _VOICES[voice]
-    estimated_duration = _estimate_duration(text)
-    candidates = []
-    for _ in range(tries):
-        with util.silence():
-            gen = _TTS.tts_with_preset(text, k=k, voice_samples=samples)
-        if isinstance(gen, list):
-            fs = [_save(g, voice) for g in gen]
-        else:
-            fs = [_save(gen, voice)]
-        candidates += [
+class TortoiseBackend:
+    """Generates with tortoise and scores with whisper. `tts_with_preset`
+    takes one text at a time, so a batch is generated sentence by sentence;
+    the scoring pass over it is still a single whisper batch."""
+
+    def generate(self, texts, voice, k, preset, skip=None):
+        """Returns a list of `k` candidate waveforms per text. Texts for which
+        `skip(ix)` is true by the time we get to them come back as None."""
+        init()
+        latents = latents_for(voice)
+        res = []
+        for ix, text in enumerate(texts):
+            if skip is not None and skip(ix):
+                res.append(None)
+                continue
+            with util.silence():
+                gen = _TTS.tts_with_preset(
+                    text, k=k, conditioning_latents=latents, preset=preset
+                )
+            res.append(gen if isinstance(gen, list) else [gen])
+        return res
+
+    def transcribe(self, waveforms):
+        return basics.transcribe_batch(waveforms, sample_rate=SAMPLE_RATE)
+
+
+class CPUBackend:
+    """Stand-in that needs no GPU or weights: candidates are quiet noise of
+    the estimated length, and transcripts are empty. For exercising the
+    batching and scoring plumbing."""
+
+    def generate(self, texts, voice, k, preset, skip=None):
+        return [
             (
-                _transcript_distance(f, text),
-                _duration_distance(f, estimated_duration),
-                f,
+                None
+                if skip is not None and skip(ix)
+                else [
+                    torch.randn(1, 1, int(duration.estimate(text, voice) * SAMPLE_RATE))
+                    * 0.01
+                    for _ in range(k)
+                ]
             )
-            for f in fs
+            for ix, text in enumerate(texts)
         ]
-        candidates.sort()
-        if candidates[0][0] < threshold or candidates[0][1] < threshold:
-            return [f for _, _, f in candidates[:k]]
 
-    return [f for _, _, f in candidates[:k]]
+    def transcribe(self, waveforms):
+        return ["" for _ in waveforms]
+
+
+BACKEND = TortoiseBackend()
+
+
+def text_to_wavs(
+    text,
+    voice=None,
+    k=3,
+    threshold=0.2,
+    tries=5,
+    preset=DEFAULT_PRESET,
+    keep_rejected=False,
+    cancelled=None,
+):
+    """Generates `k` readings of `text` and returns the paths of the best ones.
+
+    Candidates are scored while still in memory and only the final picks get
+    written to static/. Pass `keep_rejected=True` to save every candidate as
+    it is generated instead (handy for debugging the scorers). `cancelled`
+    is checked between stages; once it returns true we raise Cancelled."""
+    return text_to_wavs_batch(
+        [text],
+        voice,
+        k,
+        threshold,
+        tries,
+        preset,
+        keep_rejected,
+        cancelled=cancelled and (lambda ix: cancelled()),
+    )[0]
+
+
+@contextlib.contextmanager
+def _timed(timings, stage):
+    start = time.time()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + time.time() - start
+
+
+def _report(timings, n, discarded):
+    with _TIMINGS_LOCK:
+        for stage, seconds in timings.items():
+            TIMINGS[stage] = TIMINGS.get(stage, 0.0) + seconds
+    stages = ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in timings.items())
+    print(f"  tts x{n}: {stages}, {discarded} speculative candidates discarded")
+
+
+def text_to_wavs_batch(
+    texts,
+    voice=None,
+    k=3,
+    threshold=0.2,
+    tries=5,
+    preset=DEFAULT_PRESET,
+    keep_rejected=False,
+    backend=None,
+    cancelled=None,
+    on_done=None,
+):
+    """`text_to_wavs` for several texts read with the same settings. Each try
+    generates and scores every text that hasn't met `threshold` yet as one
+    batch. Returns a list of path lists, in the same order as `texts`.
+
+    Each text's picks are saved as soon as it meets `threshold`, rather than
+    once the whole batch is done, and `on_done(ix, paths)` gets called with
+    them right away. Texts that run out of tries are handed over at the end.
+
+    With PIPELINE on, try N+1 generates speculatively while try N is being
+    scored. Texts that try N turns out to settle are skipped if generation
+    hasn't reached them yet, and their speculative candidates are thrown away
+    if it has.
+
+    `cancelled(ix)` says whether texts[ix] is no longer wanted. It's checked
+    before each sentence is generated and between stages; cancelled texts
+    come back as None, and once every text is cancelled we raise Cancelled."""
+    assert 10 >= k >= 1, f"k must be between 1 and 10. got {k}"
+    backend = backend or BACKEND
+    if voice is None:
+        voice = DEFAULT_VOICE
+    estimates = [duration.estimate(text, voice) for text in texts]
+    candidates, seq = [[] for _ in texts], itertools.count()
+    res, delivered = [None for _ in texts], set()
+    timings, met, scoring, discarded = {"generate": 0.0, "score": 0.0}, set(), None, 0
+
+    def _score_try(flat):
+        with _timed(timings, "score"):
+            scores = _score(
+                [g for _, g in flat],
+                [texts[ix] for ix, _ in flat],
+                [estimates[ix] for ix, _ in flat],
+                backend,
+            )
+        # A text is done once its best candidate so far meets the threshold.
+        # Nothing settles while we're scoring, so `candidates` holds every
+        # earlier try already.
+        best = {ix: cands[0][:2] for ix, cands in enumerate(candidates) if cands}
+        for (ix, _), score in zip(flat, scores):
+            best[ix] = min(best.get(ix, score), score)
+        for ix in {ix for ix, _ in flat}:
+            t_dist, d_dist = best[ix]
+            if t_dist < threshold or d_dist < threshold:
+                met.add(ix)
+        return flat, scores
+
+    def _stopped(ix):
+        return ix in met or (cancelled is not None and cancelled(ix))
+
+    def _check():
+        if cancelled is not None and all(cancelled(ix) for ix in range(len(texts))):
+            raise Cancelled()
+
+    def _settle(flat, scores):
+        for (ix, g), (t_dist, d_dist) in zip(flat, scores):
+            candidates[ix].append(
+                (t_dist, d_dist, next(seq), _save(g, voice) if keep_rejected else g)
+            )
+        for ix in {ix for ix, _ in flat}:
+            candidates[ix].sort()
+            # Only the current top k can ever be returned, so don't hang on
+            # to the rest of the audio.
+            del candidates[ix][k:]
+        _deliver({ix for ix, _ in flat if ix in met})
+
+    def _deliver(ixs):
+        for ix in sorted(ixs - delivered):
+            delivered.add(ix)
+            if cancelled is not None and cancelled(ix):
+                continue
+            with _timed(timings, "save"):
+                res[ix] = [
+                    arr if keep_rejected else _save(arr, voice)
+                    for _, _, _, arr in candidates[ix]
+                ]
+            candidates[ix] = []
+            if on_done is not None:
+                on_done(ix, res[ix])
+
+    for _ in range(tries):
+        _check()
+        todo = [ix for ix in range(len(texts)) if not _stopped(ix)]
+        if not todo:
+            break
+        with _timed(timings, "generate"):
+            gens = backend.generate(
+                [texts[ix] for ix in todo],
+                voice,
+                k,
+                preset,
+                skip=lambda j: _stopped(todo[j]),
+            )
+        _check()
+        flat = [(ix, g) for ix, gen in zip(todo, gens) if gen for g in gen]
+        if cancelled is not None:
+            flat = [(ix, g) for ix, g in flat if not cancelled(ix)]
+        if scoring is not None:
+            _settle(*scoring.result())
+            scoring = None
+            discarded += sum(1 for ix, _ in flat if ix in met)
+            flat = [(ix, g) for ix, g in flat if ix not in met]
+        if not flat:
+            break
+        if PIPELINE:
+            scoring = _SCORER.submit(_score_try, flat)
+        else:
+            _settle(*_score_try(flat))
+    if scoring is not None:
+        _settle(*scoring.result())
+    _check()
+    _deliver(set(range(len(texts))))
+    _report(timings, len(texts), discarded)
+    return res
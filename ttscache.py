@@ -0,0 +1,63 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+
+import model
+import util
+
+# Finished tts outputs, shared across jobs. The index lives in the
+# `tts_cache` table; the files themselves are hardlinked between CACHE_DIR
+# and static/, so evicting an entry never breaks a job that already used it.
+CACHE_DIR = "tts-cache"
+MAX_BYTES = 5 * 2**30
+
+
+def key(text, voice, k, preset):
+    "`text` should already have been through `hax.apply`"
+    text = re.sub(r"\s+", " ", text).strip()
+    return hashlib.sha256(
+        json.dumps([text, voice, int(k), preset]).encode("utf-8")
+    ).hexdigest()
+
+
+def _link(src, dest):
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
+
+
+def lookup(cache_key, voice):
+    """Returns fresh static/ copies of the cached files for `cache_key`, or
+    None on a miss."""
+    files = model.tts_cache_hit(cache_key)
+    if files is None:
+        return None
+    if not all(os.path.isfile(f) for f in files):
+        model.tts_cache_drop(cache_key)
+        return None
+    res = []
+    for f in files:
+        fname = util.fresh_file(f"audio-{voice}-", ".wav")
+        os.unlink(fname)
+        _link(f, fname)
+        res.append(fname)
+    return res
+
+
+def store(cache_key, fnames):
+    "Adds the given static/ files to the cache under `cache_key`"
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    files = []
+    for ix, fname in enumerate(fnames):
+        cached = os.path.join(CACHE_DIR, f"{cache_key}-{ix}.wav")
+        if os.path.exists(cached):
+            os.unlink(cached)
+        _link(fname, cached)
+        files.append(cached)
+    model.tts_cache_put(cache_key, files, sum(os.path.getsize(f) for f in files))
+    for f in model.tts_cache_evict(MAX_BYTES):
+        if os.path.exists(f):
+            os.unlink(f)
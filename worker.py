@@ -1,127 +1,651 @@
+import concurrent.futures
+import contextlib
 import json
+import os
+import socket
 import threading
+import time
 
 import tornado
 import tornado.websocket
 
 import audio
 import blogcast.horrifying_hacks as hax
+import limits
 import model
 import tts
+import ttscache
 import util
 from blogcast import script
 
 AVAILABLE_JOBS = {
-    "blogcast": {"inputs": ["url", "voice", "k", "threshold", "max_tries"]},
-    "tts": {"inputs": ["text", "voice", "k", "threshold", "max_tries"]},
+    "blogcast": {
+        "inputs": [
+            "url",
+            "voice",
+            "k",
+            "threshold",
+            "max_tries",
+            "preset",
+            "segmented",
+            "segment_seconds",
+        ],
+        "resources": ["network", "cpu"],
+    },
+    "tts": {
+        "inputs": ["text", "voice", "k", "threshold", "max_tries", "preset"],
+        "resources": ["gpu:0"],
+    },
 }  # "image", "caption", "code_summarize"
 
+# How many jobs may hold each resource at once
+RESOURCES = {"gpu:0": 1, "cpu": os.cpu_count() or 1, "network": 4}
+
+# How many worker threads pull each job type
+WORKERS = {"blogcast": 2, "tts": 1}
+
+_SLOTS = {name: threading.BoundedSemaphore(n) for name, n in RESOURCES.items()}
+
+# Inputs that configure the blogcast itself rather than its tts children
+BLOGCAST_ONLY_INPUTS = {"url", "segmented", "segment_seconds"}
+
+# text_to_wavs argument -> (tts job input, default)
+TTS_SETTINGS = {
+    "voice": ("voice", tts.DEFAULT_VOICE),
+    "k": ("k", 3),
+    "threshold": ("threshold", 0.2),
+    "tries": ("max_tries", 5),
+    "preset": ("preset", tts.DEFAULT_PRESET),
+}
+
+# Queued tts jobs with the same settings are run together, up to BATCH_SIZE
+# at a time. If any mates are already queued, a worker waits at most
+# BATCH_LATENCY seconds for the batch to fill up before starting on what it
+# has; a job with nobody to share with starts right away.
+#
+# TortoiseBackend still generates sentence by sentence, so all a bigger
+# batch shares is the whisper pass, while it holds the GPU for one API key
+# that much longer. Leave this at 1 until a backend batches generation.
+BATCH_SIZE = 1
+BATCH_LATENCY = 0.2
+
 
 class SocketServer(tornado.websocket.WebSocketHandler):
+    """Pushes job updates to clients. Each client sees only its own API
+    key's jobs (optionally narrowed to `?jobs=1,2,3` and their children).
+    Updates are coalesced for COALESCE_SECONDS and sent as one list-valued
+    frame; jobs whose input and output a client has already seen are sent
+    as {"id", "status"} diffs."""
+
     CLIENTS = set()
-    IOloop = tornado.ioloop.IOLoop.current()
+    # The server's loop; `main` binds it before any worker starts
+    IOloop = None
+    COALESCE_SECONDS = 0.05
 
-    def __init__(self, *args):
-        super().__init__(*args)
-        SocketServer.IOloop = tornado.ioloop.IOLoop.current()
+    _PENDING = {}
+    _PENDING_LOCK = threading.Lock()
+    # The loop a flush is currently scheduled on, if any
+    _FLUSH_SCHEDULED = None
 
     def open(self):
+        token = self.get_argument("token", None) or self.request.headers.get(
+            "X-Auth-Token", None
+        )
+        api_key = token and model.api_key_by_token(token)
+        if not api_key:
+            return self.close(4001, "looks like you're going to the shadow realm")
+        self.api_key_id = api_key["id"]
+        jobs = self.get_argument("jobs", None)
+        self.job_ids = jobs and {int(j) for j in jobs.split(",") if j}
+        # job id -> fingerprint of the input/output this client last saw
+        self.seen = {}
         SocketServer.CLIENTS.add(self)
 
-    def close(self):
-        SocketServer.CLIENTS.remove(self)
+    def on_close(self):
+        SocketServer.CLIENTS.discard(self)
 
-    @classmethod
-    def send_message(cls, message):
-        msg = json.dumps(message)
-        print(f"UPDATING {len(cls.CLIENTS)} WS CLIENTS...")
-        for client in list(cls.CLIENTS):
-            try:
-                client.write_message(msg)
-            except tornado.websocket.WebSocketClosedError:
-                cls.CLIENTS.remove(client)
+    def wants(self, job):
+        if job["api_key_id"] != self.api_key_id:
+            return False
+        return not self.job_ids or bool({job["id"], job["parent_job"]} & self.job_ids)
+
+    @staticmethod
+    def _job_message(job):
+        return {
+            "id": job["id"],
+            "job_type": job["job_type"],
+            "status": job["status"],
+            "parent_job": job["parent_job"],
+            "input": job["input"],
+            "output": job["output"],
+        }
+
+    @staticmethod
+    def _fingerprint(job):
+        return hash(json.dumps([job["input"], job["output"]], sort_keys=True))
 
     @classmethod
     def send_job_update(cls, job):
         if job is None:
             return
-        cls.IOloop.asyncio_loop.call_soon_threadsafe(
-            cls.send_message,
-            {
-                "id": job["id"],
-                "job_type": job["job_type"],
-                "status": job["status"],
-                "parent_job": job["parent_job"],
-                "input": job["input"],
-                "output": job["output"],
-            },
-        )
+        cls.send_job_updates([job])
+
+    @classmethod
+    def send_job_updates(cls, jobs):
+        "Queues job updates; safe to call from any thread"
+        if not jobs:
+            return
+        with cls._PENDING_LOCK:
+            for job in jobs:
+                cls._PENDING[job["id"]] = job
+            loop = cls.IOloop
+            # A flush scheduled on some other loop might never run
+            if loop is None or cls._FLUSH_SCHEDULED is loop:
+                return
+            cls._FLUSH_SCHEDULED = loop
+        try:
+            loop.add_callback(loop.call_later, cls.COALESCE_SECONDS, cls._flush)
+        except Exception:
+            with cls._PENDING_LOCK:
+                if cls._FLUSH_SCHEDULED is loop:
+                    cls._FLUSH_SCHEDULED = None
+            raise
+
+    @classmethod
+    def _flush(cls):
+        with cls._PENDING_LOCK:
+            jobs, cls._PENDING = list(cls._PENDING.values()), {}
+            cls._FLUSH_SCHEDULED = None
+        if not cls.CLIENTS:
+            return
+        by_id = {job["id"]: job for job in jobs}
+        fingerprints = {jid: cls._fingerprint(job) for jid, job in by_id.items()}
+        # Clients that end up with the same frame share one encoding
+        frames = {}
+        for client in list(cls.CLIENTS):
+            shape = []
+            for job in jobs:
+                if not client.wants(job):
+                    continue
+                jid = job["id"]
+                shape.append((jid, client.seen.get(jid) != fingerprints[jid]))
+                if job["status"] in model.FINISHED_STATUS:
+                    client.seen.pop(jid, None)
+                else:
+                    client.seen[jid] = fingerprints[jid]
+            if not shape:
+                continue
+            shape = tuple(shape)
+            if shape not in frames:
+                frames[shape] = json.dumps(
+                    [
+                        (
+                            cls._job_message(by_id[jid])
+                            if full
+                            else {"id": jid, "status": by_id[jid]["status"]}
+                        )
+                        for jid, full in shape
+                    ]
+                )
+            try:
+                client.write_message(frames[shape])
+            except tornado.websocket.WebSocketClosedError:
+                cls.CLIENTS.discard(client)
+
+
+_ASSEMBLY_LOCK = threading.Lock()
+
+
+def _local(static_path):
+    return os.path.join("static", os.path.basename(static_path))
+
+
+def _assemble(parent):
+    """Appends whatever prefix of the blogcast script is now ready to the
+    parent's audio. Children that finish out of order stay on disk until the
+    ones before them are done, at which point they get picked up here.
+
+    Appending resumes from the progress recorded in the parent, so if we
+    fail partway through, the next call redoes the same stretch rather than
+    adding it twice."""
+    output = parent["output"]
+    script, children = output["script"], output.get("children")
+    if children is None:
+        # Blogcasts that fanned out before we started recording children
+        children = sorted(c["id"] for c in model.jobs_by_parent(parent["id"]))
+    progress = output.get("assembled", {"next": 0, "child": 0, "seconds": 0.0})
+    ix, cix = progress["next"], progress["child"]
+    ready = []
+    while ix < len(script):
+        el = script[ix]
+        if type(el) is str:
+            child = model.job_by_id(children[cix])
+            if child["status"] not in model.FINISHED_STATUS:
+                break
+            if child["status"] == "COMPLETE" and child["output"]:
+                if os.path.isfile(fname := _local(child["output"][0])):
+                    ready.append(fname)
+            cix += 1
+        else:
+            ready.append(el)
+        ix += 1
+    if ix == progress["next"]:
+        return parent
+
+    if "audio" in output:
+        fname = _local(output["audio"])
+    else:
+        fname = os.path.join("static", f"blogcast-{parent['id']}.wav")
+    first_file = next((f for f in ready if type(f) is str), None)
+    params = audio.params_of(first_file) if first_file else None
+    with audio.WavWriter(fname, params, keep_seconds=progress["seconds"]) as out:
+        for el in ready:
+            if type(el) is str:
+                out.write_file(el)
+            else:
+                out.write_silence(el["silence"])
+        seconds = out.seconds
+    output = {
+        **output,
+        "children": children,
+        "audio": util.force_static(fname),
+        "assembled": {"next": ix, "child": cix, "seconds": seconds},
+    }
+    if parent["input"].get("segmented"):
+        output["segments"] = _segment(parent, fname, seconds, ix == len(script))
+    res = model.update_job(parent["id"], output=output)
+    SocketServer.send_job_update(res)
+    return res
+
+
+def _segment(parent, fname, seconds, final):
+    """Cuts any newly complete segments out of the assembled audio so far,
+    and rewrites the playlist to include them."""
+    seg_seconds = float(parent["input"].get("segment_seconds", 10.0))
+    segs = parent["output"].get("segments", {"count": 0})
+    prefix = os.path.join("static", f"blogcast-{parent['id']}")
+    new = audio.write_segments(fname, prefix, segs["count"], seg_seconds, final)
+    count = segs["count"] + len(new)
+    durations = [seg_seconds] * count
+    if final and count:
+        durations[-1] = seconds - seg_seconds * (count - 1)
+    playlist = audio.write_playlist(
+        f"{prefix}.m3u8",
+        [(audio.segment_name(prefix, ix), d) for ix, d in enumerate(durations)],
+        seg_seconds,
+        final=final,
+    )
+    return {
+        "playlist": util.force_static(playlist),
+        "count": count,
+        "segment_seconds": seg_seconds,
+    }
+
+
+def _check_parent(pid):
+    """Assembles what it can of the parent's audio, and completes the parent
+    if all of its children are done. Returns the completed parent, if any."""
+    with _ASSEMBLY_LOCK:
+        parent = model.job_by_id(pid)
+        # Children can finish before their parent is done fanning out
+        if parent["status"] != "WAITING_FOR_CHILDREN":
+            return None
+        finished = model.all_children_finished_p(pid)
+        if parent["job_type"] == "blogcast":
+            try:
+                _assemble(parent)
+            except Exception as e:
+                if not finished:
+                    # The next child to finish gets us another go
+                    print(f"Failed to assemble job {pid}: {e!r}")
+                    return None
+                output = {**(parent["output"] or {}), "error": str(e)}
+                return _set_status(pid, "ERRORED", output=output)
+        if not finished:
+            return None
+        return _set_status(pid, "COMPLETE")
+
+
+# Parent bookkeeping, blogcast assembly and segment encoding included, runs
+# here under a "cpu" slot, so tts workers get straight back to the GPU.
+_PARENT_UPDATES = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="parents")
 
 
 def update_parents(job):
+    """Queues up completing every ancestor of `job` that this finishes off,
+    and returns right away."""
+    if job["parent_job"] is not None:
+        _PARENT_UPDATES.submit(_update_parents, job)
+
+
+def _update_parents(job):
+    "Failures are logged rather than raised; they're never the child's fault"
     pid = job["parent_job"]
-    while pid is not None:
-        if model.all_children_finished_p(pid):
-            res = model.update_job(pid, status="COMPLETE")
-            SocketServer.send_job_update(res)
-            parent = model.job_by_id(pid)
-            pid = parent["parent_job"]
-            if res["job_type"] == "blogcast":
-                audio.stitch(res["output"]["script"])
-        return
+    try:
+        with _slots(["cpu"]):
+            while pid is not None:
+                res = _check_parent(pid)
+                if res is None:
+                    return
+                pid = res["parent_job"]
+    except Exception as e:
+        print(f"Failed to update parent {pid} of job {job['id']}: {e!r}")
+
+
+def _resources(job_type):
+    "Holds every resource slot `job_type` declares"
+    return _slots(AVAILABLE_JOBS[job_type]["resources"])
+
+
+@contextlib.contextmanager
+def _slots(names):
+    "Holds the named resource slots, taken in a fixed order"
+    held = []
+    try:
+        for name in sorted(names):
+            _SLOTS[name].acquire()
+            held.append(name)
+        yield
+    finally:
+        for name in reversed(held):
+            _SLOTS[name].release()
+
+
+# Job id -> Event that's set if the job gets cancelled while we work on it
+_TOKENS = {}
+_TOKENS_LOCK = threading.Lock()
+
+
+@contextlib.contextmanager
+def _cancellable(jobs):
+    """Yields {job id: cancellation token} for `jobs`. Register before
+    marking jobs RUNNING, so no cancel can slip in between the two."""
+    with _TOKENS_LOCK:
+        tokens = {
+            job["id"]: _TOKENS.setdefault(job["id"], threading.Event()) for job in jobs
+        }
+    try:
+        yield tokens
+    finally:
+        with _TOKENS_LOCK:
+            for job in jobs:
+                _TOKENS.pop(job["id"], None)
+
+
+def cancel(job_ids):
+    "Tells whatever is working on any of `job_ids` to stop at its next check"
+    with _TOKENS_LOCK:
+        for jid in job_ids:
+            if jid in _TOKENS:
+                _TOKENS[jid].set()
+
+
+def _set_status(job_id, status, output=None):
+    "Updates a job we're working on, unless it's been cancelled under us"
+    res = model.update_job(
+        job_id, status=status, output=output, unless_status=model.CANCELLED_STATUS
+    )
+    SocketServer.send_job_update(res)
+    return res
 
 
 def work_on(job):
-    if job["status"] in {"CANCELLED", "DELETED"}:
+    if job["status"] in model.CANCELLED_STATUS:
         update_parents(job)
         return None
     jtype = job["job_type"]
     assert jtype in set(AVAILABLE_JOBS.keys())
+    if jtype == "tts":
+        return work_on_batch([job])
     jid = job["id"]
-    SocketServer.send_job_update(model.update_job(jid, status="RUNNING"))
+    with _cancellable([job]) as tokens:
+        if _set_status(jid, "RUNNING") is None:
+            return None
+        try:
+            with _resources(jtype):
+                _run(job, tokens[jid])
+        except Exception as e:
+            _set_status(jid, "ERRORED", output={"error": str(e)})
+        update_parents(job)
+
+
+def _tts_settings(inp):
+    "text_to_wavs keyword arguments for a tts job's input"
+    res = {}
+    for arg, (field, default) in TTS_SETTINGS.items():
+        res[arg] = default if inp.get(field) is None else inp[field]
+    return res
+
+
+def _cache_key(inp):
+    settings = _tts_settings(inp)
+    return ttscache.key(
+        hax.apply(inp["text"]), settings["voice"], settings["k"], settings["preset"]
+    )
+
+
+def _from_cache(job):
+    "Completes a tts job from the shared cache, if it's in there"
+    voice = _tts_settings(job["input"])["voice"]
+    res = ttscache.lookup(_cache_key(job["input"]), voice)
+    if res is None:
+        return False
+    _set_status(job["id"], "COMPLETE", output=[util.force_static(r) for r in res])
+    return True
+
+
+def _batch_mates(job, owner):
+    "Leases more queued tts jobs that can share a batch with `job`"
+    settings = _tts_settings(job["input"])
+    match = {
+        field: (settings[arg], default)
+        for arg, (field, default) in TTS_SETTINGS.items()
+    }
+    mates, deadline = [], time.time() + BATCH_LATENCY
+    while len(mates) < BATCH_SIZE - 1:
+        mates += model.claim_batch(
+            owner, job["api_key_id"], "tts", match, BATCH_SIZE - 1 - len(mates)
+        )
+        # tortoise still generates sentence by sentence, so holding up a
+        # lone job for company it might never get isn't worth it
+        if not mates or len(mates) >= BATCH_SIZE - 1 or time.time() >= deadline:
+            break
+        model.wait_for_jobs(deadline - time.time())
+    return mates
+
+
+def _complete_group(key, same, paths, voice):
+    "Completes every job in `same` (which all read the same text) with `paths`"
     try:
-        if jtype == "tts":
-            inp = job["input"]
-            text = inp.pop("text")
-            res = tts.text_to_wavs(hax.apply(text), **inp)
-            paths = [util.force_static(r) for r in res]
-            SocketServer.send_job_update(
-                model.update_job(
-                    jid,
-                    status="COMPLETE",
-                    output=paths,
-                )
-            )
-        elif jtype == "blogcast":
-            scr = script.script_from(job["input"]["url"])
-            SocketServer.send_job_update(
-                model.update_job(
-                    jid,
-                    status="WAITING_FOR_CHILDREN",
-                    output={"script": scr, "raw_script": scr},
-                )
+        ttscache.store(key, paths)
+    except Exception as e:
+        # The files are still fine; repeats just don't get to share them
+        print(f"Failed to cache {key}: {e}")
+    for ix, job in enumerate(same):
+        try:
+            if ix > 0:
+                # Repeats of a sentence get their own copies of the files
+                paths = ttscache.lookup(key, voice)
+                assert paths is not None, "tts cache entry went missing"
+            _set_status(
+                job["id"], "COMPLETE", output=[util.force_static(p) for p in paths]
             )
-            inp = {k: v for k, v in job["input"].items() if not k == "url"}
-            for ln in scr:
-                if type(ln) is str:
-                    SocketServer.send_job_update(
-                        model.new_job(
-                            "tts",
-                            {"text": ln, **inp},
-                            parent=jid,
-                        )
-                    )
+        except Exception as e:
+            _set_status(job["id"], "ERRORED", output={"error": str(e)})
         update_parents(job)
-    except Exception as e:
-        SocketServer.send_job_update(
-            model.update_job(jid, status="ERRORED", output={"error": str(e)})
+
+
+def work_on_batch(jobs):
+    """Runs tts jobs that share their settings. Cached sentences are served
+    without touching the GPU; the rest are generated as one batch, with each
+    distinct sentence generated once. Each job completes as soon as its
+    sentence meets the threshold, not when the whole batch is done. Jobs
+    cancelled mid-batch drop out at the next check, and the batch stops once
+    all of them have."""
+    queued = []
+    for job in jobs:
+        if job["status"] in model.CANCELLED_STATUS:
+            update_parents(job)
+            continue
+        try:
+            cached = _from_cache(job)
+        except Exception as e:
+            _set_status(job["id"], "ERRORED", output={"error": str(e)})
+            cached = True
+        if cached:
+            update_parents(job)
+            continue
+        queued.append(job)
+    with _cancellable(queued) as tokens:
+        todo = {}
+        for job in queued:
+            if _set_status(job["id"], "RUNNING") is not None:
+                todo.setdefault(_cache_key(job["input"]), []).append(job)
+        if not todo:
+            return
+        keys, groups = list(todo.keys()), list(todo.values())
+        settings, done = _tts_settings(groups[0][0]["input"]), set()
+
+        def _done(ix, paths):
+            done.add(ix)
+            _complete_group(keys[ix], groups[ix], paths, settings["voice"])
+
+        try:
+            with _resources("tts"):
+                tts.text_to_wavs_batch(
+                    [hax.apply(same[0]["input"]["text"]) for same in groups],
+                    **settings,
+                    cancelled=lambda ix: all(
+                        tokens[job["id"]].is_set() for job in groups[ix]
+                    ),
+                    on_done=_done,
+                )
+        except tts.Cancelled:
+            return
+        except Exception as e:
+            # Whatever finished before things went wrong stays finished
+            for ix, same in enumerate(groups):
+                if ix in done:
+                    continue
+                for job in same:
+                    _set_status(job["id"], "ERRORED", output={"error": str(e)})
+                    update_parents(job)
+
+
+def _run(job, token):
+    jid = job["id"]
+    if job["job_type"] == "blogcast":
+        scr = script.script_from(job["input"]["url"])
+        if token.is_set():
+            return
+        inp = {k: v for k, v in job["input"].items() if k not in BLOGCAST_ONLY_INPUTS}
+        inputs = [{"text": ln, **inp} for ln in scr if type(ln) is str]
+        # Admission only covered the scrape; the sentences have to get past
+        # the key's bucket and credits before we queue any of them
+        key_id = job["api_key_id"]
+        api_key = key_id is not None and model.api_key_by(id=key_id)
+        cost = sum(limits.job_cost("tts", i) for i in inputs) if api_key else 0
+        if cost and (refused := limits.admit(api_key, cost)):
+            raise Exception(f"{len(inputs)} sentences refused: {refused[1]}")
+        try:
+            children = model.new_jobs("tts", inputs, parent=jid)
+        except Exception:
+            limits.charge(key_id, -cost)
+            raise
+        SocketServer.send_job_updates(children)
+        waiting = _set_status(
+            jid,
+            "WAITING_FOR_CHILDREN",
+            output={
+                "script": scr,
+                "raw_script": scr,
+                "children": [c["id"] for c in children],
+            },
         )
+        if waiting is None:
+            # Cancelled while we were fanning out; take the children with it
+            SocketServer.send_job_updates(model.cancel_jobs(jid))
+            limits.charge(key_id, -cost)
+            return
+        _check_parent(jid)
 
 
-def _worker():
+# Job id -> lease owner, for every lease this process is working under. One
+# heartbeat thread keeps all of them alive.
+_LEASES = {}
+_LEASES_LOCK = threading.Lock()
+_HEARTBEAT = None
+
+
+def _heartbeat():
+    while True:
+        time.sleep(model.LEASE_SECONDS / 3)
+        with _LEASES_LOCK:
+            held = list(_LEASES.items())
+        for jid, owner in held:
+            try:
+                if model.heartbeat(jid, owner):
+                    continue
+            except Exception as e:
+                print(f"Failed to renew the lease on job {jid}: {e!r}")
+                continue
+            with _LEASES_LOCK:
+                if _LEASES.get(jid) != owner:
+                    continue
+                del _LEASES[jid]
+            # Someone else has the job now; stop before we run it twice
+            print(f"Lost the lease on job {jid}, stopping")
+            cancel([jid])
+
+
+@contextlib.contextmanager
+def _leased(jobs):
+    "Keeps the jobs' leases alive for as long as we're working on them"
+    global _HEARTBEAT
+    owner = jobs[0]["lease_owner"]
+    with _LEASES_LOCK:
+        if _HEARTBEAT is None:
+            _HEARTBEAT = threading.Thread(
+                target=_heartbeat, daemon=True, name="heartbeat"
+            )
+            _HEARTBEAT.start()
+        for job in jobs:
+            _LEASES[job["id"]] = owner
+    try:
+        yield
+    finally:
+        with _LEASES_LOCK:
+            for job in jobs:
+                _LEASES.pop(job["id"], None)
+        for job in jobs:
+            model.release_job(job["id"], owner)
+
+
+def _worker(job_type):
+    owner = f"{socket.gethostname()}:{os.getpid()}:{threading.current_thread().name}"
     while True:
-        work_on(model.pull_job())
+        try:
+            job = model.pull_job([job_type], owner)
+            if job_type == "tts" and job["status"] not in model.CANCELLED_STATUS:
+                jobs = [job] + _batch_mates(job, owner)
+                with _leased(jobs):
+                    work_on_batch(jobs)
+            else:
+                with _leased([job]):
+                    work_on(job)
+        except Exception as e:
+            # Whatever we held goes back to the queue once its lease expires
+            print(f"Worker {owner} failed: {e!r}")
+            time.sleep(1)
+
+
+def make_worker(job_type):
+    return threading.Thread(target=_worker, args=(job_type,), daemon=True)
 
 
-def make_worker():
-    return threading.Thread(target=_worker, daemon=True)
+def make_workers():
+    return [
+        make_worker(job_type)
+        for job_type, count in WORKERS.items()
+        for _ in range(count)
+    ]